@@ -0,0 +1,185 @@
+"""
+Benchmarks for read, read_all, iread, meta and serialize at several schema
+depths.
+
+The data volume is scaled by TREEFORM_BENCHMARK_SCALE, where 1 means 100k
+movies, 10k directors, 50k actors and 1M actor links. It defaults to a tiny
+scale so the benchmarks run with the normal test suite. When
+TREEFORM_BENCHMARK_OUTPUT is set the results are written there as JSON, e.g.:
+
+    TREEFORM_BENCHMARK_SCALE=0.1 TREEFORM_BENCHMARK_OUTPUT=bench.json \
+        pytest testproj/movies/benchmark_tests.py
+"""
+import json, os, random, subprocess, time, tracemalloc
+
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from testproj.movies.models import Movie, Actor, Director
+from treeform.treeform import (field, one, many, read, read_all, iread, meta,
+                               serialize, metas)
+
+SCALE = float(os.environ.get("TREEFORM_BENCHMARK_SCALE", "0.001"))
+OUTPUT = os.environ.get("TREEFORM_BENCHMARK_OUTPUT")
+PREFIX = "Benchmark"
+READ_SAMPLE = 100
+
+SCHEMAS = {
+    1: [field("title")],
+    2: [
+        field("title"),
+        one("director", [field("name"), field("age")]),
+        many("actors", [field("name"), field("education")]),
+    ],
+    3: [
+        field("title"),
+        one("director",
+            [field("name"),
+             field("age"),
+             many("movie_set", [field("title")])]),
+        many("actors", [field("name"), field("education")]),
+    ],
+}
+
+results = []
+
+
+def generate(movies, directors, actors, links, batch_size=None):
+    """Creates movies, directors, actors and movie-actor links."""
+    rng = random.Random(42)
+    Director.objects.bulk_create([
+        Director(name="{} director {}".format(PREFIX, i), age=rng.randint(
+            20, 90)) for i in range(directors)
+    ], batch_size=batch_size)
+    Actor.objects.bulk_create([
+        Actor(name="{} actor {}".format(PREFIX, i),
+              education="Education " * rng.randint(1, 20))
+        for i in range(actors)
+    ], batch_size=batch_size)
+    director_ids = list(
+        Director.objects.filter(name__startswith=PREFIX).values_list(
+            "pk", flat=True))
+    Movie.objects.bulk_create([
+        Movie(title="{} movie {}".format(PREFIX, i),
+              director_id=director_ids[i % len(director_ids)])
+        for i in range(movies)
+    ], batch_size=batch_size)
+
+    movie_ids = list(
+        Movie.objects.filter(title__startswith=PREFIX).values_list(
+            "pk", flat=True))
+    actor_ids = list(
+        Actor.objects.filter(name__startswith=PREFIX).values_list(
+            "pk", flat=True))
+    per_movie = max(1, links // len(movie_ids))
+    Movie.actors.through.objects.bulk_create([
+        Movie.actors.through(movie_id=x, actor_id=y) for x in movie_ids
+        for y in rng.sample(actor_ids, min(per_movie, len(actor_ids)))
+    ], batch_size=batch_size)
+
+
+def delete():
+    Movie.objects.filter(title__startswith=PREFIX).delete()
+    Director.objects.filter(name__startswith=PREFIX).delete()
+    Actor.objects.filter(name__startswith=PREFIX).delete()
+
+
+@pytest.fixture(scope="module")
+def movies(django_db_setup, django_db_blocker):
+    with django_db_blocker.unblock():
+        generate(movies=max(10, int(100000 * SCALE)),
+                 directors=max(1, int(10000 * SCALE)),
+                 actors=max(10, int(50000 * SCALE)),
+                 links=max(10, int(1000000 * SCALE)))
+        yield Movie.objects.filter(title__startswith=PREFIX).order_by("pk")
+        delete()
+
+    if OUTPUT:
+        with open(OUTPUT, "w") as fp:
+            json.dump({
+                "commit": commit(),
+                "scale": SCALE,
+                "results": results
+            }, fp, indent=4)
+
+
+def commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                       stderr=subprocess.DEVNULL).decode(
+                                           "utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench(name, depth, fn, setup=None):
+    """Runs fn and records its time, query count and peak memory. The time
+    is taken from a run without tracing, as tracemalloc slows allocations
+    unevenly, and the rest from a second run. setup, if given, is called
+    before each run to reset the state the first run changed."""
+    if setup is not None:
+        setup()
+    start = time.perf_counter()
+    value = fn()
+    elapsed = time.perf_counter() - start
+
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    with CaptureQueriesContext(connection) as queries:
+        fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    results.append({
+        "name": name,
+        "depth": depth,
+        "time": elapsed,
+        "queries": len(queries),
+        "peak_memory": peak,
+    })
+
+    return value
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("depth", sorted(SCHEMAS))
+def test_read(movies, depth):
+    sample = []
+
+    def setup():
+        # Fresh instances, read caches the relations it fetches on them.
+        sample[:] = movies[:READ_SAMPLE]
+
+    bench("read", depth, lambda: [read(x, SCHEMAS[depth]) for x in sample],
+          setup)
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("depth", sorted(SCHEMAS))
+def test_read_all(movies, depth):
+    trees = bench("read_all", depth, lambda: read_all(movies, SCHEMAS[depth]))
+    assert len(trees) == movies.count()
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("depth", sorted(SCHEMAS))
+def test_iread(movies, depth):
+    count = bench(
+        "iread", depth,
+        lambda: sum(1 for _ in iread(movies, SCHEMAS[depth], chunk_size=500)))
+    assert count == movies.count()
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("depth", sorted(SCHEMAS))
+def test_meta(movies, depth):
+    bench("meta", depth, lambda: meta(Movie, SCHEMAS[depth]), metas.clear)
+    bench("meta_cached", depth, lambda: meta(Movie, SCHEMAS[depth]))
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("depth", sorted(SCHEMAS))
+def test_serialize(movies, depth):
+    trees = read_all(movies, SCHEMAS[depth])
+    bench("serialize", depth, lambda: serialize(trees))
@@ -15,3 +15,9 @@ class Movie(m.Model):
     title = m.TextField("Movie Title")
     actors = m.ManyToManyField(Actor)
     director = m.ForeignKey(Director, on_delete=m.PROTECT)
+
+
+class Genre(m.Model):
+    name = m.TextField()
+    parent = m.ForeignKey("self", null=True, blank=True,
+                          related_name="children", on_delete=m.CASCADE)
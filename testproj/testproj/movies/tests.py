@@ -1,12 +1,29 @@
+import copy, gzip, json, os
+from concurrent.futures import Future, ThreadPoolExecutor
+
 import pytest
-from testproj.movies.models import Movie, Actor, Director
+from testproj.movies.models import Movie, Actor, Director, Genre
+from treeform.models import SchemaVersion
 
+from asgiref.sync import async_to_sync
 from django.core.management import call_command
+from django.db.models.signals import post_init
 from django.db.models.fields import NOT_PROVIDED
-from django.db.models import fields
+from django.db.models import fields, F, Max, Min
+from django.db.models.functions import Length
 
+from treeform import treeform
 from treeform.treeform import (dcomp, field, one, many, read, meta, pp,
-                               serialize)
+                               serialize, prefetch, read_all, compile, READ,
+                               iread, iserialize, iserialize_all, write,
+                               aread, aread_all, profiled, measure, pp_stats,
+                               explain, assert_max_queries, annotate,
+                               aggregate, count, select, recursive, load,
+                               identity_map)
+from treeform.triggers import install
+from treeform.cache import LRUCache, cached_read
+from treeform.diff import diff, patch, hash_tree
+from treeform.sql import read_sql
 
 
 @pytest.fixture(scope='session')
@@ -15,6 +32,14 @@ def django_db_setup(django_db_setup, django_db_blocker):
         call_command('loaddata', 'test_fixtures.json')
 
 
+@pytest.fixture(autouse=True)
+def fixtures_loaded(django_db_setup, django_db_blocker):
+    """Reloads the fixtures after transactional tests flushed them."""
+    with django_db_blocker.unblock():
+        if not Movie.objects.filter(pk=1).exists():
+            call_command('loaddata', 'test_fixtures.json')
+
+
 VIEW_MOVIE_SCHEMA = [
     field("title"),
     one("director",
@@ -48,6 +73,513 @@ def test_read():
         }
 
 
+class InlineExecutor():
+    """Executor running submitted functions in the calling thread, so their
+    queries can be counted."""
+
+    def submit(self, fn, *args):
+        future = Future()
+        future.set_result(fn(*args))
+
+        return future
+
+
+def create_movies(n):
+    director = Director.objects.create(name="Director", age=40)
+    actors = [
+        Actor.objects.create(name="Actor {}".format(i), education="None")
+        for i in range(3)
+    ]
+    for i in range(n):
+        movie = Movie.objects.create(
+            title="Movie {}".format(i), director=director)
+        movie.actors.set(actors)
+
+
+@pytest.mark.django_db
+def test_compile():
+    create_movies(2)
+    reader = compile(VIEW_MOVIE_SCHEMA)
+    assert compile(VIEW_MOVIE_SCHEMA) is reader
+    for movie in Movie.objects.all():
+        assert reader(movie) == dcomp(READ, VIEW_MOVIE_SCHEMA, movie,
+                                      {})[0][1]
+
+
+@pytest.mark.django_db
+def test_prefetch(django_assert_num_queries):
+    expected = [read(x, VIEW_MOVIE_SCHEMA) for x in Movie.objects.all()]
+    with django_assert_num_queries(3):
+        assert [
+            read(x, VIEW_MOVIE_SCHEMA)
+            for x in prefetch(Movie.objects.all(), VIEW_MOVIE_SCHEMA)
+        ] == expected
+
+    create_movies(10)
+    with django_assert_num_queries(3):
+        assert len([
+            read(x, VIEW_MOVIE_SCHEMA)
+            for x in prefetch(Movie.objects.all(), VIEW_MOVIE_SCHEMA)
+        ]) == 11
+
+
+@pytest.mark.django_db
+def test_prefetch_only():
+    schema = [
+        field("title"),
+        one("director", [field("name")]),
+        many("actors", [field("name")]),
+    ]
+    queryset = prefetch(Movie.objects.all(), schema)
+    assert '"age"' not in str(queryset.query)
+    assert [read(x, schema) for x in queryset] == [{
+        "title": "The Matrix",
+        "director": {
+            "name": "Wachowski Sisters"
+        },
+        "actors": [{
+            "name": "Keanu Reeves"
+        }, {
+            "name": "Carrie-Anne Moss"
+        }],
+    }]
+
+
+@pytest.mark.django_db
+def test_read_all(django_assert_num_queries):
+    create_movies(10)
+    expected = [
+        read(x, VIEW_MOVIE_SCHEMA) for x in Movie.objects.order_by("-pk")
+    ]
+    with django_assert_num_queries(4):
+        assert read_all(Movie.objects.order_by("-pk"),
+                        VIEW_MOVIE_SCHEMA) == expected
+
+
+@pytest.mark.django_db
+def test_many_options(django_assert_num_queries):
+    create_movies(3)
+    schema = [
+        field("title"),
+        many("actors", [field("name")], filter={"name__startswith": "Actor"},
+             order_by=["-name"], limit=2, offset=1),
+    ]
+    movies = Movie.objects.filter(title__startswith="Movie").order_by("pk")
+    expected = [{
+        "title": "Movie {}".format(i),
+        "actors": [{
+            "name": "Actor 1"
+        }, {
+            "name": "Actor 0"
+        }],
+    } for i in range(3)]
+    assert [read(x, schema) for x in movies] == expected
+    with django_assert_num_queries(2):
+        assert read_all(movies, schema) == expected
+    with django_assert_num_queries(2):
+        assert [read(x, schema) for x in prefetch(movies, schema)] == expected
+
+    director = Director.objects.get(name="Director")
+    with django_assert_num_queries(1):
+        assert read_all([director], [
+            many("movie_set", [field("title")], order_by=["-title"], limit=2)
+        ]) == [{
+            "movie_set": [{
+                "title": "Movie 2"
+            }, {
+                "title": "Movie 1"
+            }]
+        }]
+
+    options = meta(Movie, schema)["actors"]["options"]
+    assert options["limit"] == 2 and options["order_by"] == ["-name"]
+    assert meta(Movie, schema)["actors"]["version_hash"] != meta(
+        Actor, [field("name")])["version_hash"]
+
+    schema = [
+        field("title"),
+        many("actors", [field("name")], filter={"name__startswith": "Actor"},
+             order_by=[F("name").desc()], limit=2, offset=1),
+    ]
+    assert [read(x, schema) for x in movies] == expected
+    assert read_all(movies, schema) == expected
+    assert meta(Movie, schema)["actors"]["options"]["order_by"] == [
+        str(F("name").desc())
+    ]
+    with pytest.raises(AssertionError):
+        many("actors", [field("name")], order_by=["?"], limit=1)
+
+
+@pytest.mark.django_db
+def test_aggregates(django_assert_num_queries):
+    create_movies(2)
+    schema = [
+        field("title"),
+        count("actors"),
+        annotate("title_length", Length("title")),
+        one("director", [
+            field("name"),
+            count("movie_set", name="movies"),
+            aggregate("movie_set", Max("title")),
+        ]),
+    ]
+    movies = Movie.objects.filter(title__startswith="Movie").order_by("pk")
+    expected = [{
+        "title": "Movie {}".format(i),
+        "actors_count": 3,
+        "title_length": 7,
+        "director": {
+            "name": "Director",
+            "movies": 2,
+            "movie_set__title__max": "Movie 1",
+        },
+    } for i in range(2)]
+    assert [read(x, schema) for x in movies] == expected
+    with django_assert_num_queries(2):
+        assert read_all(movies, schema) == expected
+    with django_assert_num_queries(2):
+        assert [read(x, schema) for x in prefetch(movies, schema)] == expected
+    with django_assert_num_queries(2):
+        assert read_all(list(Movie.objects.filter(pk__in=movies)),
+                        [count("actors")]) == [{"actors_count": 3}] * 2
+
+    counted = [field("title"), count("actors")]
+    with django_assert_num_queries(2):
+        assert read_all(list(movies), counted,
+                        executor=InlineExecutor()) == read_all(
+                            movies, counted)
+    assert async_to_sync(aread)(movies[0],
+                                counted) == read(movies[0], counted)
+    assert async_to_sync(aread_all)(movies, counted,
+                                    thread_sensitive=True) == read_all(
+                                        movies, counted)
+    assert assert_max_queries(movies, counted, 2) == read_all(movies, counted)
+
+    metadata = meta(Movie, schema)
+    assert metadata["fields"]["actors_count"]["type"] is fields.IntegerField
+    assert metadata["director"]["fields"]["movie_set__title__max"][
+        "type"] is fields.TextField
+    assert metadata["ordering"] == ["title", "actors_count", "title_length"]
+    hashes = [
+        meta(Movie, [annotate("x", Length("title"))])["version_hash"],
+        meta(Movie, [annotate("x", Length("id"))])["version_hash"],
+        meta(Director,
+             [aggregate("movie_set", Max("title"), name="t")])["version_hash"],
+        meta(Director,
+             [aggregate("movie_set", Min("title"), name="t")])["version_hash"],
+    ]
+    assert len(set(hashes)) == 4
+
+
+@pytest.mark.django_db
+def test_lazy(django_assert_num_queries):
+    create_movies(5)
+    movies = Movie.objects.order_by("pk")
+    expected = read_all(movies, VIEW_MOVIE_SCHEMA)
+
+    with django_assert_num_queries(1):
+        trees = read_all(movies, VIEW_MOVIE_SCHEMA, lazy=True)
+        assert [x["title"] for x in trees] == [x["title"] for x in expected]
+    with django_assert_num_queries(1):
+        assert [x["actors"] for x in trees] == [
+            x["actors"] for x in expected
+        ]
+    with django_assert_num_queries(2):
+        assert serialize(trees) == serialize(expected)
+    with django_assert_num_queries(0):
+        assert trees == expected
+
+    movie = Movie.objects.get(pk=1)
+    with django_assert_num_queries(1):
+        tree = read(movie, VIEW_MOVIE_SCHEMA, lazy=True)
+        assert tree["director"]["name"] == "Wachowski Sisters"
+    assert dict(tree) == read(movie, VIEW_MOVIE_SCHEMA)
+
+
+@pytest.mark.django_db
+def test_select(django_assert_num_queries):
+    paths = "title,director.name,actors.name"
+    schema = select(VIEW_MOVIE_SCHEMA, paths)
+    assert select(VIEW_MOVIE_SCHEMA,
+                  ["actors.name", "director.name", "title"]) is schema
+    assert [x.k for x in schema] == ["title", "director", "actors"]
+    assert [x.k for x in schema[1].fns] == ["name"]
+    assert [x.k for x in VIEW_MOVIE_SCHEMA[1].fns] == [
+        "name", "age", "movie_set"
+    ]
+    with pytest.raises(Exception):
+        select(VIEW_MOVIE_SCHEMA, "title.name")
+    with pytest.raises(Exception):
+        select(VIEW_MOVIE_SCHEMA, "year")
+
+    movie = Movie.objects.get(pk=1)
+    with django_assert_num_queries(2):
+        assert read(movie, VIEW_MOVIE_SCHEMA, include=paths) == {
+            "title": "The Matrix",
+            "director": {
+                "name": "Wachowski Sisters"
+            },
+            "actors": [{
+                "name": "Keanu Reeves"
+            }, {
+                "name": "Carrie-Anne Moss"
+            }],
+        }
+    with django_assert_num_queries(3):
+        read_all(Movie.objects.all(), VIEW_MOVIE_SCHEMA, include=paths)
+
+    assert meta(Movie, schema)["version_hash"] == meta(
+        Movie, [
+            field("title"),
+            one("director", [field("name")]),
+            many("actors", [field("name")]),
+        ])["version_hash"]
+    assert meta(Movie, schema)["director"]["fields"]["name"] == meta(
+        Movie, VIEW_MOVIE_SCHEMA)["director"]["fields"]["name"]
+
+
+@pytest.mark.django_db
+def test_read_sql(django_assert_num_queries):
+    create_movies(3)
+    movies = Movie.objects.order_by("pk")
+    schema = [
+        field("title"),
+        count("actors"),
+        one("director", [
+            field("name"),
+            many("movie_set", [field("title")], order_by=["-title"],
+                 limit=2, offset=1),
+        ]),
+    ]
+    expected = read_all(movies, schema)
+    with django_assert_num_queries(1):
+        assert read_sql(movies, schema) == expected
+    with django_assert_num_queries(1):
+        trees = read_sql(movies, VIEW_MOVIE_SCHEMA)
+    assert trees == read_all(movies, VIEW_MOVIE_SCHEMA)
+    with django_assert_num_queries(1):
+        raw = read_sql(movies, VIEW_MOVIE_SCHEMA, raw=True)
+    assert json.loads(raw.decode("utf-8")) == trees
+
+
+@pytest.mark.django_db
+def test_recursive(django_assert_num_queries):
+    drama = Genre.objects.create(name="Drama")
+    crime = Genre.objects.create(name="Crime", parent=drama)
+    Genre.objects.create(name="Romance", parent=drama)
+    heist = Genre.objects.create(name="Heist", parent=crime)
+    Genre.objects.create(name="Caper", parent=heist)
+    Genre.objects.create(name="Comedy")
+
+    def genre(name, *children):
+        return {"name": name, "children": list(children)}
+
+    schema = [field("name"), recursive("children", [field("name")])]
+    expected = [
+        genre("Drama",
+              genre("Crime", genre("Heist", genre("Caper"))),
+              genre("Romance")),
+        genre("Comedy"),
+    ]
+    with django_assert_num_queries(2):
+        assert read_all(Genre.objects.filter(parent=None).order_by("pk"),
+                        schema) == expected
+    with django_assert_num_queries(1):
+        assert read(drama, schema) == expected[0]
+    assert len(explain(Genre, schema)) == 2
+
+    schema = [field("name"), recursive("children", [field("name")], 2)]
+    with django_assert_num_queries(2):
+        assert read_all(Genre.objects.filter(pk=drama.pk), schema) == [
+            genre("Drama", genre("Crime", genre("Heist")), genre("Romance"))
+        ]
+
+    roots = list(Genre.objects.filter(parent=None).order_by("pk"))
+    schema = [field("name"), recursive("children", [field("name")])]
+    with django_assert_num_queries(1):
+        assert read_all(roots, schema, executor=InlineExecutor()) == expected
+    roots = list(Genre.objects.filter(parent=None).order_by("pk"))
+    with django_assert_num_queries(1):
+        trees = read_all(roots, schema, lazy=True)
+        assert [x["children"] for x in trees] == [
+            x["children"] for x in expected
+        ]
+    assert async_to_sync(aread_all)(roots, schema,
+                                    thread_sensitive=True) == expected
+    assert read(drama, schema, profile=True)[0] == expected[0]
+
+    schema = [field("name"), recursive("children", [field("name")], 2)]
+    metadata = meta(Genre, schema)
+    assert metadata["children"]["options"] == {
+        "recursive": True,
+        "max_depth": 2
+    }
+    assert metadata["children"]["ordering"] == ["name"]
+
+
+@pytest.mark.django_db
+def test_identity(django_assert_num_queries):
+    create_movies(5)
+    movies = Movie.objects.filter(title__startswith="Movie").order_by("pk")
+    expected = read_all(movies, VIEW_MOVIE_SCHEMA)
+    assert expected[0]["director"] is not expected[1]["director"]
+
+    instances = load(list(movies), VIEW_MOVIE_SCHEMA)
+    assert instances[0].actors.all()[0] is instances[1].actors.all()[0]
+
+    with django_assert_num_queries(4):
+        trees = read_all(movies, VIEW_MOVIE_SCHEMA, identity="share")
+    assert trees == expected
+    assert trees[0]["director"] is trees[1]["director"]
+    assert trees[0]["actors"][0] is trees[1]["actors"][0]
+
+    trees = read_all(movies, VIEW_MOVIE_SCHEMA, identity="copy")
+    assert trees == expected
+    assert trees[0]["director"] is not trees[1]["director"]
+
+    trees = list(iread(movies, VIEW_MOVIE_SCHEMA, 3, identity="share"))
+    assert trees == expected
+    assert trees[0]["director"] is trees[2]["director"]
+    assert trees[0]["director"] is not trees[3]["director"]
+
+    drama = Genre.objects.create(name="Drama")
+    crime = Genre.objects.create(name="Crime", parent=drama)
+    Genre.objects.create(name="Heist", parent=crime)
+    schema = [field("name"), recursive("children", [field("name")], 1)]
+    genres = Genre.objects.order_by("pk")
+    assert read_all(genres, schema, identity="share") == read_all(
+        genres, schema)
+
+    with identity_map():
+        assert read(Genre(name="A"), [field("name")]) == {"name": "A"}
+        assert read(Genre(name="B"), [field("name")]) == {"name": "B"}
+
+
+@pytest.mark.django_db
+def test_iread(django_assert_num_queries):
+    create_movies(10)
+    expected = read_all(Movie.objects.order_by("pk"), VIEW_MOVIE_SCHEMA)
+    trees = iread(Movie.objects.order_by("pk"), VIEW_MOVIE_SCHEMA,
+                  chunk_size=5)
+    with django_assert_num_queries(1 + 3 * 3):
+        assert list(trees) == expected
+
+
+@pytest.mark.django_db
+def test_iserialize():
+    create_movies(3)
+    trees = read_all(Movie.objects.all(), VIEW_MOVIE_SCHEMA)
+    assert b"".join(iserialize_all(iter(trees), chunk_size=10)).decode(
+        "utf-8") == serialize(trees)
+    assert b"".join(iserialize_all(iter(trees), ndjson=True)).decode(
+        "utf-8") == "".join(serialize(x) + "\n" for x in trees)
+
+    meta_data = meta(Movie, VIEW_MOVIE_SCHEMA)
+    assert b"".join(iserialize(meta_data, indent=4)).decode(
+        "utf-8") == serialize(meta_data, indent=4)
+
+
+@pytest.mark.django_db
+def test_aread(monkeypatch):
+    movie = Movie.objects.get(pk=1)
+    assert async_to_sync(aread)(movie, VIEW_MOVIE_SCHEMA) == read(
+        movie, VIEW_MOVIE_SCHEMA)
+
+    create_movies(3)
+    closed = []
+    monkeypatch.setattr(treeform, "close_old_connections",
+                        lambda: closed.append(True))
+    assert async_to_sync(aread_all)(
+        Movie.objects.order_by("pk"), VIEW_MOVIE_SCHEMA,
+        thread_sensitive=True) == read_all(Movie.objects.order_by("pk"),
+                                           VIEW_MOVIE_SCHEMA)
+    assert not closed
+
+    # The director instance is fetched when the tree is built.
+    schema = [field("title"), field("director")]
+    assert async_to_sync(aread)(Movie.objects.get(pk=1),
+                                schema, thread_sensitive=True) == read(
+                                    Movie.objects.get(pk=1), schema)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_aread_threads():
+    create_movies(3)
+    expected = read_all(Movie.objects.order_by("pk"), VIEW_MOVIE_SCHEMA)
+    assert async_to_sync(aread_all)(Movie.objects.order_by("pk"),
+                                    VIEW_MOVIE_SCHEMA) == expected
+
+
+@pytest.mark.django_db
+def test_read_all_executor():
+    expected = read_all(Movie.objects.all(), VIEW_MOVIE_SCHEMA)
+    with ThreadPoolExecutor(2) as executor:
+        assert read_all(Movie.objects.all(), VIEW_MOVIE_SCHEMA,
+                        executor=executor, using=["default"]) == expected
+
+    class CheckingExecutor(InlineExecutor):
+        # Sibling branches must not race to create the prefetch cache.
+        def submit(self, fn, source, *args):
+            assert all(
+                hasattr(x, "_prefetched_objects_cache") for x in source)
+            return super().submit(fn, source, *args)
+
+    assert read_all(Movie.objects.all(), VIEW_MOVIE_SCHEMA,
+                    executor=CheckingExecutor()) == expected
+
+
+@pytest.mark.django_db
+def test_profile(capsys):
+    movie = Movie.objects.get(pk=1)
+    output, stats = read(movie, VIEW_MOVIE_SCHEMA, profile=True)
+    assert output == read(movie, VIEW_MOVIE_SCHEMA)
+    title, director, actors = stats["children"]
+    assert stats["queries"] == 3
+    assert (title["queries"], title["rows"]) == (0, 1)
+    assert (director["queries"], director["objects"]) == (2, 2)
+    assert director["children"][2]["queries"] == 1
+    assert (actors["queries"], actors["rows"], actors["objects"]) == (1, 2, 2)
+
+    schema, stats = profiled(VIEW_MOVIE_SCHEMA)
+    with measure(stats):
+        read_all(Movie.objects.all(), schema)
+    assert stats["queries"] == 4
+    assert [x["queries"] for x in stats["children"]] == [0, 2, 1]
+
+    pp_stats(stats)
+    assert "director (one): 2 queries" in capsys.readouterr().out
+
+    size = len(treeform.compiled)
+    read(movie, VIEW_MOVIE_SCHEMA, profile=True)
+    assert len(treeform.compiled) == size
+    assert not post_init.disconnect(treeform.count_object,
+                                    dispatch_uid=treeform.__name__)
+
+
+@pytest.mark.django_db
+def test_explain(django_assert_num_queries):
+    with django_assert_num_queries(0):
+        queries = explain(Movie, VIEW_MOVIE_SCHEMA)
+    assert [(x["path"], x["relation"], x["model"], x["columns"])
+            for x in queries] == [
+                ("", "root", Movie, ["director", "title"]),
+                ("director", "one", Director, ["age", "name"]),
+                ("director__movie_set", "many", Movie, ["director", "title"]),
+                ("actors", "many", Actor, ["education", "name"]),
+            ]
+    assert '"movies_movie"."director_id" IN (%s)' in queries[2]["sql"]
+
+    movies = Movie.objects.all()
+    assert assert_max_queries(movies, VIEW_MOVIE_SCHEMA) == read_all(
+        movies, VIEW_MOVIE_SCHEMA)
+    with pytest.raises(AssertionError):
+        assert_max_queries(movies, VIEW_MOVIE_SCHEMA, 3)
+    # Reading the director instance of each movie is an N+1 the static
+    # count of the schema can not see.
+    with pytest.raises(AssertionError):
+        assert_max_queries(movies, [field("title"), field("director")])
+
+
 @pytest.mark.django_db
 def test_meta():
     meta_data = serialize(meta(Movie, VIEW_MOVIE_SCHEMA), indent=4)
@@ -156,7 +688,7 @@ def test_meta():
             },
             "version_hash": "e377fa0c879470efb735231ce6806f8b"
         },
-        "version_hash": "315e9b956204acf65c1fc7d86a58bd9f"
+        "version_hash": "3a7ebfc154f61a7e186cb2b0320d2342"
     },
     "actors": {
         "model": [
@@ -206,6 +738,327 @@ def test_meta():
         },
         "version_hash": "73e8b5532945734f9dd37b4327cb3707"
     },
-    "version_hash": "1680b821b17a3ea498a057c378f9776f"
+    "version_hash": "cd9c951d70e11a6d6fa71828e6445c16"
 }
 """.strip()
+
+
+def test_meta_cache():
+    assert meta(Movie, VIEW_MOVIE_SCHEMA) is meta(Movie, VIEW_MOVIE_SCHEMA)
+    schema = [
+        field("title"),
+        one("director", [many("movie_set", [field("title")])]),
+    ]
+    other = [
+        field("title"),
+        one("director",
+            [many("movie_set", [field("title"),
+                                field("director")])]),
+    ]
+    version_hash = meta(Movie, schema)["version_hash"]
+    assert version_hash != meta(Movie, other)["version_hash"]
+
+
+@pytest.mark.django_db
+def test_triggers():
+    install(Movie, VIEW_MOVIE_SCHEMA, "view_movie")
+
+    def version(pk):
+        return SchemaVersion.objects.get(schema="view_movie",
+                                         object_id=pk).version
+
+    Director.objects.filter(pk=1).update(name="The Wachowskis")
+    assert version(1) == 1
+    Actor.objects.filter(pk=2).update(education="Great")
+    assert version(1) == 2
+    Movie.objects.get(pk=1).actors.remove(2)
+    assert version(1) == 3
+    movie = Movie.objects.create(title="The Matrix Reloaded", director_id=1)
+    assert version(1) == 4
+    assert version(movie.pk) == 1
+    Actor.objects.filter(pk=2).update(education="Even better")
+    assert version(1) == 4
+
+
+@pytest.mark.django_db
+def test_triggers_options():
+    install(Movie, [
+        field("title"),
+        many("actors", [field("name")], filter={"education": "The best"}),
+    ], "best_actors")
+    Actor.objects.filter(pk=2).update(education="The best")
+    assert SchemaVersion.objects.get_versions("best_actors", [1]) == {1: 1}
+
+
+@pytest.mark.django_db
+def test_triggers_recursive():
+    drama = Genre.objects.create(name="Drama")
+    crime = Genre.objects.create(name="Crime", parent=drama)
+    schema = [field("name"), recursive("children", [field("name")], 3)]
+    install(Genre, schema, "genre")
+
+    def version(pk):
+        return SchemaVersion.objects.get_versions("genre", [pk])[pk]
+
+    heist = Genre.objects.create(name="Heist", parent=crime)
+    assert (version(drama.pk), version(crime.pk)) == (1, 1)
+    Genre.objects.filter(pk=heist.pk).update(name="Caper")
+    assert (version(drama.pk), version(crime.pk)) == (2, 2)
+    Genre.objects.filter(pk=heist.pk).update(parent=drama)
+    assert (version(drama.pk), version(crime.pk)) == (3, 3)
+
+    with pytest.raises(Exception):
+        install(Genre, [recursive("children", [field("name")])], "genre")
+
+
+@pytest.mark.django_db
+def test_schema_versions(django_assert_num_queries):
+    with django_assert_num_queries(1):
+        SchemaVersion.objects.bump("view_movie", [1, 2, 2])
+    with django_assert_num_queries(1):
+        SchemaVersion.objects.bump("view_movie", [2, 3])
+    with django_assert_num_queries(1):
+        versions = SchemaVersion.objects.get_versions("view_movie",
+                                                      [1, 2, 3, 4])
+    assert versions == {1: 1, 2: 2, 3: 1, 4: 0}
+
+
+class ReplicaRouter():
+    def db_for_read(self, model, **hints):
+        return "replica"
+
+
+@pytest.mark.django_db
+def test_schema_versions_router(settings):
+    settings.DATABASE_ROUTERS = [
+        "testproj.movies.tests.ReplicaRouter"
+    ]
+    SchemaVersion.objects.bump("view_movie", [1])
+    settings.DATABASE_ROUTERS = []
+    assert SchemaVersion.objects.get_versions("view_movie", [1]) == {1: 1}
+
+
+@pytest.mark.django_db
+def test_cached_read(django_assert_num_queries):
+    cache = LRUCache()
+    movie = Movie.objects.get(pk=1)
+    expected = read(movie, VIEW_MOVIE_SCHEMA)
+    data = cached_read(movie, VIEW_MOVIE_SCHEMA, "view_movie", cache)
+    assert data == expected
+    data["title"] = "Changed"
+    with django_assert_num_queries(1):
+        assert cached_read(movie, VIEW_MOVIE_SCHEMA, "view_movie",
+                           cache) == expected
+
+    cached_read(movie, VIEW_MOVIE_SCHEMA, "view_movie",
+                cache)["director"]["name"] = "Changed"
+    assert cached_read(movie, VIEW_MOVIE_SCHEMA, "view_movie",
+                       cache) == expected
+
+    # Names count their versions separately, so they share no entries.
+    SchemaVersion.objects.bump("view_movie", [1])
+    SchemaVersion.objects.bump("view_movie", [1])
+    cached_read(movie, VIEW_MOVIE_SCHEMA, "view_movie", cache)
+    Movie.objects.filter(pk=1).update(title="The Matrix Revolutions")
+    SchemaVersion.objects.bump("movie_page", [1])
+    SchemaVersion.objects.bump("movie_page", [1])
+    movie = Movie.objects.get(pk=1)
+    assert cached_read(movie, VIEW_MOVIE_SCHEMA, "movie_page",
+                       cache)["title"] == "The Matrix Revolutions"
+
+    Director.objects.filter(pk=1).update(name="The Wachowskis")
+    SchemaVersion.objects.bump("view_movie", [1])
+    movie = Movie.objects.get(pk=1)
+    assert cached_read(movie, VIEW_MOVIE_SCHEMA, "view_movie",
+                       cache)["director"]["name"] == "The Wachowskis"
+
+
+EDIT_MOVIE_SCHEMA = [
+    field("id"),
+    field("title"),
+    one("director", [field("id"), field("name")]),
+    many("actors", [field("id"), field("name")]),
+]
+
+
+@pytest.mark.django_db
+def test_write():
+    data = read(Movie.objects.get(pk=1), EDIT_MOVIE_SCHEMA)
+    data["title"] = "The Matrix Reloaded"
+    data["director"]["name"] = "The Wachowskis"
+    data["actors"] = [
+        {
+            "id": 1,
+            "name": "Keanu Charles Reeves"
+        },
+        {
+            "name": "Laurence Fishburne"
+        },
+    ]
+    write(Movie.objects.get(pk=1), EDIT_MOVIE_SCHEMA, data)
+
+    data = read(Movie.objects.get(pk=1), EDIT_MOVIE_SCHEMA)
+    assert data["title"] == "The Matrix Reloaded"
+    assert data["director"] == {"id": 1, "name": "The Wachowskis"}
+    assert [x["name"] for x in data["actors"]] == [
+        "Keanu Charles Reeves", "Laurence Fishburne"
+    ]
+    assert Actor.objects.filter(pk=2).exists()
+
+
+@pytest.mark.django_db
+def test_write_router(settings):
+    movie = Movie.objects.get(pk=1)
+    data = read(movie, EDIT_MOVIE_SCHEMA)
+    data["title"] = "The Matrix Reloaded"
+    actor = Actor.objects.create(name="Hugo Weaving", education="None")
+    data["actors"] = [{"id": actor.pk, "name": "Hugo Weaving"}]
+    movie = Movie.objects.get(pk=1)
+    # Reading from the missing replica fails, so writes must not.
+    settings.DATABASE_ROUTERS = ["testproj.movies.tests.ReplicaRouter"]
+    write(movie, EDIT_MOVIE_SCHEMA, data)
+    settings.DATABASE_ROUTERS = []
+    assert read(Movie.objects.get(pk=1), EDIT_MOVIE_SCHEMA) == data
+
+
+@pytest.mark.django_db
+def test_write_many(django_assert_max_num_queries):
+    schema = [
+        field("name"),
+        many("movie_set", [field("id"), field("title")]),
+    ]
+    director = Director.objects.create(name="Lana", age=55)
+    write(director, schema, {
+        "name": "Lana Wachowski",
+        "movie_set": [{
+            "title": "Cloud Atlas"
+        }, {
+            "title": "Sense8"
+        }],
+    })
+    director = Director.objects.get(pk=director.pk)
+    data = read(director, schema)
+    assert [x["title"] for x in data["movie_set"]] == ["Cloud Atlas", "Sense8"]
+
+    data["movie_set"] = [
+        dict(x, title=x["title"] + "!") for x in data["movie_set"][:1]
+    ]
+    with django_assert_max_num_queries(7):
+        write(director, schema, data)
+    assert read(Director.objects.get(pk=director.pk), schema) == data
+
+
+@pytest.mark.django_db
+def test_write_move():
+    schema = [
+        field("name"),
+        many("children", [
+            field("id"),
+            field("name"),
+            many("children", [field("id"), field("name")]),
+        ]),
+    ]
+    root = Genre.objects.create(name="Root")
+    a = Genre.objects.create(name="A", parent=root)
+    b = Genre.objects.create(name="B", parent=root)
+    c = Genre.objects.create(name="C", parent=root)
+    moved = Genre.objects.create(name="Moved", parent=a)
+
+    data = read(root, schema)
+    data["children"][1]["children"] = data["children"][0]["children"]
+    data["children"][0]["children"] = []
+    del data["children"][2]
+    write(Genre.objects.get(pk=root.pk), schema, data)
+
+    assert Genre.objects.get(pk=moved.pk).parent_id == b.pk
+    assert Genre.objects.get(pk=c.pk).parent_id is None
+    assert read(Genre.objects.get(pk=root.pk), schema) == data
+
+
+def test_diff():
+    schema = [
+        field("title"),
+        one("director", [field("name")]),
+        many("actors", [field("id"), field("name")]),
+    ]
+    old = {
+        "title": "The Matrix",
+        "director": {"name": "Wachowski Sisters"},
+        "actors": [{"id": 1, "name": "Keanu Reeves"},
+                   {"id": 2, "name": "Carrie-Anne Moss"}],
+    }
+    new = {
+        "title": "The Matrix",
+        "director": {"name": "The Wachowskis"},
+        "actors": [{"id": 3, "name": "Laurence Fishburne"},
+                   {"id": 1, "name": "Keanu Charles Reeves"}],
+    }
+    delta = diff(old, new, schema)
+    assert delta == [
+        {"op": "change", "path": ["director", "name"],
+         "value": "The Wachowskis"},
+        {"op": "remove", "path": ["actors"], "key": 2},
+        {"op": "add", "path": ["actors"], "index": 0,
+         "value": new["actors"][0]},
+        {"op": "change", "path": ["actors", 1, "name"],
+         "value": "Keanu Charles Reeves"},
+    ]
+    assert patch(old, delta, schema) == new
+    assert diff(old, dict(old, actors=old["actors"][::-1]), schema) == [{
+        "op": "order", "path": ["actors"], "value": [2, 1]}]
+
+    assert diff(old, old, schema, old_hashes=hash_tree(old, schema),
+                new_hashes=hash_tree(copy.deepcopy(old), schema)) == []
+
+
+@pytest.mark.django_db
+def test_export(tmpdir):
+    create_movies(10)
+    output = str(tmpdir)
+    call_command("treeform_export", "movies.Movie",
+                 "testproj.movies.tests.VIEW_MOVIE_SCHEMA", output,
+                 "--shards", "3", "--workers", "0")
+    with open(os.path.join(output, "manifest.json")) as fp:
+        manifest = json.load(fp)
+    assert len(manifest["shards"]) == 3
+
+    trees = []
+    for shard in manifest["shards"]:
+        with gzip.open(os.path.join(output, shard["file"]), "rt") as fp:
+            trees.extend(json.loads(x) for x in fp)
+    assert trees == read_all(Movie.objects.order_by("pk"), VIEW_MOVIE_SCHEMA)
+
+    manifest["shards"][-1]["count"] = None
+    with open(os.path.join(output, "manifest.json"), "w") as fp:
+        json.dump(manifest, fp)
+    os.remove(os.path.join(output, manifest["shards"][-1]["file"]))
+    call_command("treeform_export", "movies.Movie",
+                 "testproj.movies.tests.VIEW_MOVIE_SCHEMA", output,
+                 "--workers", "0")
+    assert os.path.exists(os.path.join(output, manifest["shards"][-1]["file"]))
+
+    manifest["version_hash"] = "changed"
+    with open(os.path.join(output, "manifest.json"), "w") as fp:
+        json.dump(manifest, fp)
+    with pytest.raises(Exception):
+        call_command("treeform_export", "movies.Movie",
+                     "testproj.movies.tests.VIEW_MOVIE_SCHEMA", output,
+                     "--workers", "0")
+
+
+@pytest.mark.django_db(transaction=True)
+def test_export_workers(tmpdir):
+    create_movies(10)
+    output = str(tmpdir)
+    call_command("treeform_export", "movies.Movie",
+                 "testproj.movies.tests.VIEW_MOVIE_SCHEMA", output,
+                 "--shards", "3", "--workers", "2")
+    with open(os.path.join(output, "manifest.json")) as fp:
+        manifest = json.load(fp)
+    assert sum(x["count"] for x in manifest["shards"]) == Movie.objects.count()
+
+    trees = []
+    for shard in manifest["shards"]:
+        with gzip.open(os.path.join(output, shard["file"]), "rt") as fp:
+            trees.extend(json.loads(x) for x in fp)
+    assert trees == read_all(Movie.objects.order_by("pk"), VIEW_MOVIE_SCHEMA)
@@ -0,0 +1,93 @@
+from collections import OrderedDict
+from copy import deepcopy
+from threading import Lock
+
+from django.core.cache import caches
+
+from treeform.models import SchemaVersion
+from treeform.treeform import meta, read_all
+
+
+class LRUCache():
+    """In-process least recently used cache with the get/set part of the
+    Django cache API. Values are copied on set and get, like the pickling
+    backends do, so callers can not change what is stored."""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                self.data.move_to_end(key)
+            except KeyError:
+                return default
+
+            value = self.data[key]
+
+        return deepcopy(value)
+
+    def set(self, key, value):
+        value = deepcopy(value)
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def get_many(self, keys):
+        found = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                found[key] = value
+
+        return found
+
+    def set_many(self, data):
+        for key, value in data.items():
+            self.set(key, value)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+def cache_key(name, version_hash, pk, version):
+    return "treeform:{}:{}:{}:{}".format(name, version_hash, pk, version)
+
+
+def cached_read(source, schema, name, cache=None):
+    """Returns read(source, schema) from cache if neither schema nor the
+    SchemaVersion of name for source has changed since it was stored."""
+    return cached_read_all([source], schema, name, cache)[0]
+
+
+def cached_read_all(source, schema, name, cache=None):
+    """Batch version of cached_read. Versions are fetched in one query, hits
+    with one get_many and only the misses are read."""
+    if cache is None:
+        cache = caches["default"]
+    source = list(source)
+    if not source:
+        return []
+
+    version_hash = meta(type(source[0]), schema)["version_hash"]
+    versions = SchemaVersion.objects.get_versions(name,
+                                                  [x.pk for x in source])
+    keys = [
+        cache_key(name, version_hash, x.pk, versions[x.pk]) for x in source
+    ]
+    found = cache.get_many(keys)
+
+    missing = [(k, x) for k, x in zip(keys, source) if k not in found]
+    if missing:
+        data = dict(
+            zip([k for k, _ in missing],
+                read_all([x for _, x in missing], schema)))
+        cache.set_many(data)
+        found.update(data)
+
+    return [found[k] for k in keys]
@@ -0,0 +1,136 @@
+import copy, hashlib
+
+from treeform.treeform import field, one, many, serialize
+
+HASH = "#"
+
+
+def hash_tree(tree, schema):
+    """Returns a tree of hashes for tree read with schema. Each one and many
+    item gets a HASH computed from its fields and the hashes of its
+    children, so equal hashes mean equal subtrees."""
+    hashes, values = {}, []
+    for node in schema:
+        if isinstance(node, one):
+            value = tree[node.k]
+            if value is None:
+                values.append(None)
+            else:
+                hashes[node.k] = hash_tree(value, node.fns)
+                values.append(hashes[node.k][HASH])
+        elif isinstance(node, many):
+            hashes[node.k] = [hash_tree(x, node.fns) for x in tree[node.k]]
+            values.append([x[HASH] for x in hashes[node.k]])
+        else:
+            values.append(tree[node.k])
+
+    hashes[HASH] = hashlib.md5(serialize(values).encode("utf-8")).hexdigest()
+
+    return hashes
+
+
+def diff(old, new, schema, key="id", old_hashes=None, new_hashes=None):
+    """Returns the list of operations that patch needs to turn the tree old
+    into new. Items of many nodes are matched by their key field. Subtrees
+    with equal hashes from hash_tree are skipped without comparing them."""
+    delta = []
+    diff_tree(old, new, schema, key, old_hashes, new_hashes, [], delta)
+
+    return delta
+
+
+def diff_tree(old, new, schema, key, old_hashes, new_hashes, path, delta):
+    if old is new or (old_hashes is not None and new_hashes is not None
+                      and old_hashes[HASH] == new_hashes[HASH]):
+        return
+
+    for node in schema:
+        k = node.k
+        if isinstance(node, one):
+            if old[k] is None or new[k] is None:
+                if old[k] != new[k]:
+                    delta.append({"op": "change", "path": path + [k],
+                                  "value": new[k]})
+            else:
+                diff_tree(old[k], new[k], node.fns, key,
+                          sub_hashes(old_hashes, k), sub_hashes(new_hashes, k),
+                          path + [k], delta)
+        elif isinstance(node, many):
+            diff_many(old[k], new[k], node, key, sub_hashes(old_hashes, k),
+                      sub_hashes(new_hashes, k), path + [k], delta)
+        elif isinstance(node, field):
+            if old[k] != new[k]:
+                delta.append({"op": "change", "path": path + [k],
+                              "value": new[k]})
+        else:
+            raise Exception("Can not diff {}.".format(node))
+
+
+def sub_hashes(hashes, k):
+    return None if hashes is None else hashes.get(k)
+
+
+def diff_many(old, new, node, key, old_hashes, new_hashes, path, delta):
+    if not all(key in x for x in old) or not all(key in x for x in new):
+        if old != new:
+            delta.append({"op": "change", "path": path, "value": new})
+        return
+
+    old_index = {x[key]: i for i, x in enumerate(old)}
+    new_keys = set(x[key] for x in new)
+    survivors = [x[key] for x in old if x[key] in new_keys]
+    for x in old:
+        if x[key] not in new_keys:
+            delta.append({"op": "remove", "path": path, "key": x[key]})
+
+    for i, x in enumerate(new):
+        if x[key] not in old_index:
+            delta.append({"op": "add", "path": path, "index": i, "value": x})
+            survivors.insert(i, x[key])
+        else:
+            j = old_index[x[key]]
+            diff_tree(old[j], x, node.fns, key,
+                      None if old_hashes is None else old_hashes[j],
+                      None if new_hashes is None else new_hashes[i],
+                      path + [x[key]], delta)
+
+    if survivors != [x[key] for x in new]:
+        delta.append({"op": "order", "path": path,
+                      "value": [x[key] for x in new]})
+
+
+def patch(tree, delta, schema, key="id"):
+    """Returns a copy of tree with the operations from diff applied."""
+    tree = copy.deepcopy(tree)
+    for op in delta:
+        if op["op"] == "change":
+            parent = find(tree, op["path"][:-1], schema, key)
+            parent[op["path"][-1]] = copy.deepcopy(op["value"])
+        else:
+            items = find(tree, op["path"], schema, key)
+            if op["op"] == "remove":
+                items[:] = [x for x in items if x[key] != op["key"]]
+            elif op["op"] == "add":
+                items.insert(op["index"], copy.deepcopy(op["value"]))
+            elif op["op"] == "order":
+                index = {x[key]: x for x in items}
+                items[:] = [index[x] for x in op["value"]]
+            else:
+                raise Exception("Unknown operation {}.".format(op["op"]))
+
+    return tree
+
+
+def find(tree, path, schema, key):
+    """Returns the part of tree at path."""
+    path = list(path)
+    while path:
+        k = path.pop(0)
+        node = next(x for x in schema if x.k == k)
+        tree = tree[k]
+        if isinstance(node, many) and path:
+            pk = path.pop(0)
+            tree = next(x for x in tree if x[key] == pk)
+        schema = getattr(node, "fns", None)
+
+    return tree
@@ -0,0 +1,129 @@
+import gzip, json, os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+from django.apps import apps
+from django.db import connections
+from django.db.models import Manager, Max, Min, QuerySet
+from django.utils.module_loading import import_string
+
+from treeform.treeform import dump, iread, meta
+
+MANIFEST = "manifest.json"
+
+
+def resolve_queryset(path):
+    """Returns the queryset for path, either an app_label.Model label or a
+    dotted path to a queryset, manager or callable returning a queryset."""
+    if path.count(".") == 1:
+        return apps.get_model(path)._default_manager.all()
+
+    thing = import_string(path)
+    if isinstance(thing, Manager):
+        return thing.all()
+    elif isinstance(thing, QuerySet):
+        return thing.all()
+    else:
+        return thing()
+
+
+def shards(queryset, count):
+    """Splits the pk range of queryset into count [lo, hi) ranges."""
+    bounds = queryset.aggregate(lo=Min("pk"), hi=Max("pk"))
+    if bounds["lo"] is None:
+        return []
+    lo, hi = bounds["lo"], bounds["hi"] + 1
+    size = max(1, -(-(hi - lo) // count))
+
+    return [[x, min(x + size, hi)] for x in range(lo, hi, size)]
+
+
+def export_shard(queryset_path, schema_path, lo, hi, filename, chunk_size):
+    """Writes the trees of the roots in [lo, hi) to the gzipped NDJSON file
+    filename and returns the number of trees written."""
+    queryset = resolve_queryset(queryset_path).filter(
+        pk__gte=lo, pk__lt=hi).order_by("pk")
+    schema = import_string(schema_path)
+    count = 0
+
+    def counted(trees):
+        nonlocal count
+        for tree in trees:
+            count += 1
+            yield tree
+
+    with gzip.open(filename + ".tmp", "wb") as fp:
+        dump(counted(iread(queryset, schema, chunk_size)), fp, ndjson=True)
+    os.replace(filename + ".tmp", filename)
+
+    return count
+
+
+def write_manifest(directory, manifest):
+    filename = os.path.join(directory, MANIFEST)
+    with open(filename + ".tmp", "w") as fp:
+        json.dump(manifest, fp, indent=4)
+    os.replace(filename + ".tmp", filename)
+
+
+def export(queryset_path, schema_path, directory, shard_count=16, workers=4,
+           chunk_size=2000, log=None):
+    """Exports the trees for the roots of queryset_path read with the schema
+    at schema_path as gzipped NDJSON parts in directory. A manifest records
+    the shards and the finished parts, so a crashed export resumes from the
+    last finished shard, unless the schema has changed since. With workers
+    set to 0 the shards are exported in the current process."""
+    os.makedirs(directory, exist_ok=True)
+    filename = os.path.join(directory, MANIFEST)
+    queryset = resolve_queryset(queryset_path)
+    version_hash = meta(queryset.model,
+                        import_string(schema_path))["version_hash"]
+    if os.path.exists(filename):
+        with open(filename) as fp:
+            manifest = json.load(fp)
+        if (manifest["queryset"], manifest["schema"]) != (queryset_path,
+                                                          schema_path):
+            raise Exception("{} belongs to another export.".format(filename))
+        if manifest["version_hash"] != version_hash:
+            raise Exception(
+                "{} was written with another version of the schema.".format(
+                    filename))
+    else:
+        manifest = {
+            "queryset": queryset_path,
+            "schema": schema_path,
+            "version_hash": version_hash,
+            "shards": [{
+                "lo": lo,
+                "hi": hi,
+                "file": "part-{:05d}.ndjson.gz".format(i),
+                "count": None,
+            } for i, (lo, hi) in enumerate(shards(queryset, shard_count))],
+        }
+        write_manifest(directory, manifest)
+
+    todo = [x for x in manifest["shards"] if x["count"] is None]
+    args = [(queryset_path, schema_path, x["lo"], x["hi"],
+             os.path.join(directory, x["file"]), chunk_size) for x in todo]
+
+    def done(shard, count):
+        shard["count"] = count
+        write_manifest(directory, manifest)
+        if log is not None:
+            log("Exported {} ({} trees).".format(shard["file"], count))
+
+    if workers == 0:
+        for shard, x in zip(todo, args):
+            done(shard, export_shard(*x))
+    else:
+        connections.close_all()
+        with ProcessPoolExecutor(workers,
+                                 initializer=django.setup) as executor:
+            futures = {
+                executor.submit(export_shard, *x): shard
+                for shard, x in zip(todo, args)
+            }
+            for future in as_completed(futures):
+                done(futures[future], future.result())
+
+    return manifest
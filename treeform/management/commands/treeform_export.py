@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from treeform.export import export
+
+
+class Command(BaseCommand):
+    help = ("Exports the trees of a schema for every root in a queryset as "
+            "gzipped NDJSON parts plus a manifest. Rerunning the command "
+            "resumes an unfinished export.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "queryset",
+            help=("Root model as app_label.Model or dotted path to a "
+                  "queryset, manager or callable returning a queryset."))
+        parser.add_argument("schema", help="Dotted path to the schema.")
+        parser.add_argument("output", help="Directory to write to.")
+        parser.add_argument("--shards", type=int, default=16)
+        parser.add_argument(
+            "--workers", type=int, default=4,
+            help="Number of worker processes, 0 exports in this process.")
+        parser.add_argument("--chunk-size", type=int, default=2000)
+
+    def handle(self, *args, **options):
+        export(options["queryset"], options["schema"], options["output"],
+               shard_count=options["shards"], workers=options["workers"],
+               chunk_size=options["chunk_size"], log=self.stdout.write)
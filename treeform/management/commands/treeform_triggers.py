@@ -0,0 +1,39 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.utils.module_loading import import_string
+
+from treeform.triggers import create_sql, drop_sql
+
+
+class Command(BaseCommand):
+    help = ("Creates database triggers that bump SchemaVersion rows when "
+            "data read by a schema changes.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("model", help="Root model as app_label.Model.")
+        parser.add_argument("schema", help="Dotted path to the schema.")
+        parser.add_argument(
+            "--name",
+            help="SchemaVersion name of the schema. Defaults to its path.")
+        parser.add_argument("--database", default="default")
+        parser.add_argument("--drop", action="store_true",
+                            help="Drop the triggers instead.")
+        parser.add_argument("--sql", action="store_true",
+                            help="Print the SQL instead of executing it.")
+
+    def handle(self, *args, **options):
+        model = apps.get_model(options["model"])
+        schema = import_string(options["schema"])
+        name = options["name"] or options["schema"]
+        connection = connections[options["database"]]
+        sql = (drop_sql if options["drop"] else create_sql)(
+            model, schema, name, connection.vendor)
+
+        if options["sql"]:
+            for statement in sql:
+                self.stdout.write(statement + ";")
+        else:
+            with connection.cursor() as cursor:
+                for statement in sql:
+                    cursor.execute(statement)
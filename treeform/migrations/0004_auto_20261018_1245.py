@@ -0,0 +1,50 @@
+# Generated by Django 3.0.7 on 2026-10-18 12:45
+
+from django.db import migrations, models
+from django.db.models import Count, Max, Min
+
+
+def merge_duplicates(apps, schema_editor):
+    """Merges the SchemaVersion rows of the same schema and object into the
+    first, keeping the highest version, so the unique constraint can be
+    added."""
+    SchemaVersion = apps.get_model('treeform', 'SchemaVersion')
+    versions = SchemaVersion.objects.using(schema_editor.connection.alias)
+    duplicates = versions.order_by().values('schema', 'object_id').annotate(
+        count=Count('pk'), first=Min('pk'),
+        version=Max('version')).filter(count__gt=1)
+    for row in list(duplicates):
+        rows = versions.filter(schema=row['schema'],
+                               object_id=row['object_id'])
+        rows.exclude(pk=row['first']).delete()
+        rows.update(version=row['version'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('treeform', '0003_auto_20200612_0741'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='schemaversion',
+            name='object_id',
+            field=models.PositiveIntegerField(verbose_name='Id of object'),
+        ),
+        migrations.AlterField(
+            model_name='schemaversion',
+            name='schema',
+            field=models.TextField(verbose_name='Unique name of the schema'),
+        ),
+        migrations.AlterField(
+            model_name='schemaversion',
+            name='version',
+            field=models.PositiveIntegerField(verbose_name='Current version of the schema for given object_id'),
+        ),
+        migrations.RunPython(merge_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='schemaversion',
+            constraint=models.UniqueConstraint(fields=('schema', 'object_id'), name='treeform_schemaversion_unique'),
+        ),
+    ]
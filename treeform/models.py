@@ -1,11 +1,71 @@
-from django.db import models as m
+from django.db import models as m, connections, router, transaction
+from django.db.models import F
+
+
+class SchemaVersionManager(m.Manager):
+    def get_versions(self, schema, ids):
+        """Returns a dict of object id to version for ids. Objects without a
+        row have version 0."""
+        versions = dict.fromkeys(ids, 0)
+        if versions:
+            versions.update(
+                self.filter(schema=schema, object_id__in=versions).
+                values_list("object_id", "version"))
+
+        return versions
+
+    def bump(self, schema, ids):
+        """Increments the version of schema for ids, creating missing rows."""
+        ids = list(dict.fromkeys(ids))
+        if not ids:
+            return
+
+        using = self._db or router.db_for_write(self.model)
+        connection = connections[using]
+        if connection.vendor not in ("sqlite", "postgresql"):
+            with transaction.atomic(using=using):
+                self.db_manager(using).bulk_create([
+                    SchemaVersion(schema=schema, version=0, object_id=x)
+                    for x in ids
+                ], ignore_conflicts=True)
+                self.db_manager(using).filter(
+                    schema=schema,
+                    object_id__in=ids).update(version=F("version") + 1)
+            return
+
+        opts = self.model._meta
+        table = connection.ops.quote_name(opts.db_table)
+        schema_column, version, object_id = (connection.ops.quote_name(
+            opts.get_field(x).column) for x in ("schema", "version",
+                                                "object_id"))
+        batch_size = connection.ops.bulk_batch_size(["schema", "object_id"],
+                                                    ids)
+        with connection.cursor() as cursor:
+            for i in range(0, len(ids), batch_size):
+                batch = ids[i:i + batch_size]
+                cursor.execute(
+                    "INSERT INTO {table} ({schema}, {version}, {object_id}) "
+                    "VALUES {values} ON CONFLICT ({schema}, {object_id}) "
+                    "DO UPDATE SET {version} = {table}.{version} + 1".format(
+                        table=table, schema=schema_column, version=version,
+                        object_id=object_id,
+                        values=", ".join(["(%s, 1, %s)"] * len(batch))),
+                    [y for x in batch for y in (schema, x)])
 
 
 class SchemaVersion(m.Model):
-    schema = m.TextField("Unique name of the schema", db_index=True)
+    schema = m.TextField("Unique name of the schema")
     version = m.PositiveIntegerField(
-        "Current version of the schema for given object_id", db_index=True)
-    object_id = m.PositiveIntegerField("Id of object", db_index=True)
+        "Current version of the schema for given object_id")
+    object_id = m.PositiveIntegerField("Id of object")
+
+    objects = SchemaVersionManager()
+
+    class Meta:
+        constraints = [
+            m.UniqueConstraint(fields=["schema", "object_id"],
+                               name="treeform_schemaversion_unique"),
+        ]
 
 
 """
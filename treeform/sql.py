@@ -0,0 +1,126 @@
+import json
+
+from django.db.models import (BooleanField, Expression, OuterRef, Subquery,
+                              TextField, F)
+from django.db.models.fields.related_descriptors import (
+    ForwardManyToOneDescriptor)
+
+from treeform.treeform import (field, one, many, annotate, dgets,
+                               related_lookup)
+
+JSON = "treeform_json"
+FUNCTIONS = {"sqlite": "json_object", "postgresql": "json_build_object"}
+TEMPLATES = {
+    ("sqlite", False): "json((%(subquery)s))",
+    ("sqlite", True): "(SELECT json_group_array(json({})) FROM "
+    "(%(subquery)s) treeform_rows)".format(JSON),
+    ("postgresql", False): "(%(subquery)s)",
+    ("postgresql", True): "(SELECT coalesce(json_agg({}), '[]'::json) FROM "
+    "(%(subquery)s) treeform_rows)".format(JSON),
+}
+
+
+class JSONObject(Expression):
+    """JSON object with the values of the (key, expression) pairs. With text
+    the object is returned as text on backends with a JSON type."""
+
+    def __init__(self, pairs, text=False):
+        super().__init__(output_field=TextField())
+        self.keys = [k for k, _ in pairs]
+        self.values = [v for _, v in pairs]
+        self.text = text
+
+    def get_source_expressions(self):
+        return self.values
+
+    def set_source_expressions(self, exprs):
+        self.values = exprs
+
+    def as_sql(self, compiler, connection):
+        if connection.vendor not in FUNCTIONS:
+            raise Exception("Can not build JSON on {}.".format(
+                connection.vendor))
+
+        parts, params = [], []
+        for k, value in zip(self.keys, self.values):
+            sql, value_params = compiler.compile(value)
+            if connection.vendor == "sqlite" and isinstance(
+                    value.output_field, BooleanField):
+                sql = ("json(CASE WHEN ({0}) IS NULL THEN 'null' WHEN ({0}) "
+                       "THEN 'true' ELSE 'false' END)".format(sql))
+                value_params = tuple(value_params) * 2
+            parts.append("'{}', {}".format(k.replace("'", "''"), sql))
+            params.extend(value_params)
+
+        sql = "{}({})".format(FUNCTIONS[connection.vendor], ", ".join(parts))
+        if self.text and connection.vendor == "postgresql":
+            sql += "::text"
+
+        return sql, params
+
+
+class JSONSubquery(Subquery):
+    """Subquery selecting the JSON of the related row of a one node, or the
+    JSON array of the related rows of a many node."""
+
+    def __init__(self, queryset, many=False):
+        super().__init__(queryset, output_field=TextField())
+        self.many = many
+
+    def as_sql(self, compiler, connection, template=None, **extra_context):
+        return super().as_sql(compiler, connection,
+                              TEMPLATES[connection.vendor, self.many],
+                              **extra_context)
+
+
+def json_object(source, schema, text=False):
+    """Returns a JSONObject expression building the output of schema for rows
+    of the model source."""
+    pairs = []
+    for node in schema:
+        if isinstance(node, annotate):
+            pairs.append((node.k, node.resolve(source)))
+        elif isinstance(node, field):
+            pairs.append((node.k, F(node.k)))
+        elif isinstance(node, (one, many)):
+            pairs.append((node.k,
+                          JSONSubquery(related_rows(source, node),
+                                       isinstance(node, many))))
+        else:
+            raise Exception("Can not read {} with SQL.".format(node))
+
+    return JSONObject(pairs, text)
+
+
+def related_rows(source, node):
+    """Returns a queryset selecting the JSON of the rows related to the outer
+    row of source by node."""
+    lookup = related_lookup(source, node.k)[:-len("__in")]
+    outer = node.k if isinstance(dgets(source, node.k),
+                                 ForwardManyToOneDescriptor) else "pk"
+    queryset = node.queryset(source, False).filter(**{
+        lookup: OuterRef(outer)
+    })
+    if isinstance(node, many) and node.windowed:
+        queryset = queryset[node.offset:None if node.limit is None else node.
+                            offset + node.limit]
+
+    return queryset.annotate(**{
+        JSON: json_object(queryset.model, node.fns)
+    }).values(JSON)
+
+
+def read_sql(queryset, schema, raw=False):
+    """Reads schema for each row of queryset with a single query that builds
+    the JSON in the database, using JSON1 on SQLite and json_build_object
+    and json_agg on PostgreSQL. Returns the same as read_all for schemas
+    reading JSON types, or with raw the JSON array as bytes without parsing
+    it in Python. Only model fields, annotations and one and many nodes are
+    supported."""
+    rows = queryset.annotate(**{
+        JSON: json_object(queryset.model, schema, text=True)
+    }).values_list(JSON, flat=True)
+    if raw:
+        return ("[" + ", ".join(rows) + "]").encode("utf-8")
+
+    return [json.loads(x) for x in rows]
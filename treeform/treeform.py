@@ -1,11 +1,29 @@
-import json, hashlib
-from collections import Mapping
+import asyncio, copy, json, hashlib, random, sys, threading, time
+from collections import OrderedDict
+from collections.abc import Mapping
+from contextlib import ExitStack
+from functools import wraps
+from itertools import islice
+
+from asgiref.sync import sync_to_async
 
 from django.db.models.fields import NOT_PROVIDED
-from django.db.models import Model
+from django.db import (connections, router, transaction,
+                       close_old_connections)
+from django.db.models import (F, Q, Count, Model, OuterRef, QuerySet,
+                              Prefetch, Subquery, Window,
+                              prefetch_related_objects)
+from django.db.models.expressions import OrderBy, RawSQL
+from django.db.models.functions import Coalesce, RowNumber
 from django.db.models.fields.related_descriptors import (
+    ForwardManyToOneDescriptor, ReverseOneToOneDescriptor,
     ReverseManyToOneDescriptor, ManyToManyDescriptor)
 from django.db.models.fields import Field
+from django.test.utils import CaptureQueriesContext
+from django.db.models.query_utils import DeferredAttribute
+from django.core.exceptions import FieldDoesNotExist
+from django.core.signals import setting_changed
+from django.db.models.signals import class_prepared, post_init
 
 
 def comp(fns, *args, **kwargs):
@@ -78,6 +96,8 @@ def maps(k, fns):
 READ = "read"
 WRITE = "write"
 META = "meta"
+PLAN = "plan"
+LOAD = "load"
 
 
 def dcomp(mode, fns, *args, **kwargs):
@@ -110,28 +130,897 @@ def dsets(thing, key, value):
     return thing
 
 
-def read(source, schema):
-    return dcomp(READ, schema, source, {})[0][1]
+def related_model(source, k):
+    """Returns the model at the other end of the relation k on source."""
+    field = dgets(source, k)
+    if isinstance(field, ForwardManyToOneDescriptor):
+        return field.field.related_model
+    elif type(field) is ReverseOneToOneDescriptor:
+        return field.related.related_model
+    elif type(field) is ReverseManyToOneDescriptor:
+        return field.rel.related_model
+    elif type(field) is ManyToManyDescriptor:
+        return field.rel.related_model if field.reverse else field.rel.model
+    else:
+        raise Exception("Unknown relation type for {}.".format(k))
+
+
+def accessor(cls, k):
+    """Returns a function that does dgets for k on instances of cls."""
+    if issubclass(cls, Mapping):
+        return lambda thing: thing[k]
+
+    descriptor = getattr(cls, k, None)
+    if isinstance(descriptor,
+                  (ReverseManyToOneDescriptor, ManyToManyDescriptor)):
+        return lambda thing: getattr(thing, k).all()
+    elif isinstance(descriptor,
+                    (DeferredAttribute, ForwardManyToOneDescriptor,
+                     ReverseOneToOneDescriptor)):
+        return lambda thing: getattr(thing, k)
+    else:
+        return lambda thing: dgets(thing, k)
+
+
+def getter(k):
+    """Returns a dgets for k that resolves its accessor once per class."""
+    accessors = {}
+
+    def get(thing):
+        fn = accessors.get(thing.__class__)
+        if fn is None:
+            fn = accessors[thing.__class__] = accessor(thing.__class__, k)
+
+        return fn(thing)
+
+    return get
+
+
+COMPILE_CACHE_SIZE = 1024
+compiled = {}
+
+
+def compile(schema, mode=READ):
+    """Compiles schema into a function taking a source and returning the same
+    output as dcomp for mode. Results are cached by schema identity, so
+    schemas must not be changed after their first use."""
+    key = (id(schema), mode)
+    cached = compiled.get(key)
+    if cached is not None and cached[0] is schema:
+        return cached[1]
+
+    if mode == READ:
+        readers = [
+            x.reader() if getattr(x, "reader", None) is not None else
+            (lambda fn: lambda source, dest: fn.read(source, dest))(x)
+            for x in schema
+        ]
+
+        def build(source):
+            dest = {}
+            for reader in readers:
+                reader(source, dest)
+
+            return dest
+
+        def fn(source):
+            memo = getattr(identities, "memo", None)
+            if memo is None or not isinstance(source,
+                                              Model) or source.pk is None:
+                return build(source)
+
+            outputs, deep = memo
+            key = (type(source), source.pk, id(schema))
+            dest = outputs.get(key)
+            if dest is None:
+                dest = outputs[key] = build(source)
+                return dest
+
+            return copy.deepcopy(dest) if deep else dest
+    else:
+
+        def fn(source):
+            return dcomp(mode, schema, source, {})[0][1]
+
+    if len(compiled) >= COMPILE_CACHE_SIZE:
+        compiled.clear()
+    compiled[key] = (schema, fn)
+
+    return fn
+
+
+def read(source, schema, profile=False, lazy=False, include=None):
+    """Reads schema from source. With profile a (output, stats) tuple is
+    returned, see profiled. With lazy a LazyTree is returned. include limits
+    the output to the given paths, see select."""
+    if include is not None:
+        schema = select(schema, include)
+    if lazy:
+        return LazyGroup([source], schema).tree(source)
+    if profile:
+        schema, stats = profiled(schema)
+        # The copy is new on every call, so it is not compiled and cached.
+        with measure(stats):
+            output = dcomp(READ, schema, source, {})[0][1]
+
+        return output, stats
+
+    return compile(schema)(source)
+
+
+def read_all(source, schema, executor=None, using=None, lazy=False,
+             include=None, identity=None):
+    """Reads schema for each instance in the queryset or iterable source,
+    loading every relation level in bulk. See load for executor and using.
+    With lazy a list of LazyTree sharing their loads is returned. include
+    limits the output to the given paths, see select. identity is None,
+    "share" or "copy", see identity_map."""
+    if include is not None:
+        schema = select(schema, include)
+    if isinstance(source, QuerySet):
+        source = project(source, schema)
+        if using is not None:
+            source = source.using(database(using))
+    source = list(source)
+    if lazy:
+        group = LazyGroup(source, schema, database(using))
+        return [group.tree(x) for x in source]
+    load(source, schema, executor, using)
+
+    if identity is None:
+        return [read(x, schema) for x in source]
+    with identity_map(identity):
+        return [read(x, schema) for x in source]
+
+
+SELECT_CACHE_SIZE = 256
+selected = OrderedDict()
+selected_lock = threading.Lock()
+
+
+def select(schema, paths):
+    """Returns schema pruned to paths, an iterable or comma separated string
+    of dotted keys such as "title,director.name". A path ending at a one or
+    many node keeps its whole sub schema. Pruned schemas are cached by schema
+    identity and the set of paths, so their compiled readers and meta are
+    built only once."""
+    if isinstance(paths, str):
+        paths = paths.split(",")
+    paths = tuple(sorted(set(x.strip() for x in paths if x.strip())))
+    key = (id(schema), paths)
+    with selected_lock:
+        cached = selected.get(key)
+        if cached is not None and cached[0] is schema:
+            selected.move_to_end(key)
+            return cached[1]
+
+    tree = {}
+    for path in paths:
+        branch = tree
+        for k in path.split("."):
+            branch = branch.setdefault(k, {})
+    pruned = prune(schema, tree)
+
+    with selected_lock:
+        selected[key] = (schema, pruned)
+        while len(selected) > SELECT_CACHE_SIZE:
+            selected.popitem(last=False)
+
+    return pruned
+
+
+def prune(schema, tree):
+    keys = set(x.k for x in schema)
+    unknown = [k for k in tree if k not in keys]
+    if unknown:
+        raise Exception("Unknown path {}.".format(", ".join(unknown)))
+
+    pruned = []
+    for node in schema:
+        if node.k not in tree:
+            continue
+        if tree[node.k]:
+            if not hasattr(node, "fns"):
+                raise Exception("{} has no children.".format(node.k))
+            node = copy.copy(node)
+            node.fns = prune(node.fns, tree[node.k])
+        pruned.append(node)
+
+    return pruned
+
+
+identities = threading.local()
+
+
+class identity_map():
+    """Context manager making reads inside it build the output of a model
+    instance read with a given sub schema only once, keyed by model, pk and
+    schema. With mode "share" later reads return that same output, with
+    "copy" a deep copy of it."""
+
+    def __init__(self, mode="share"):
+        if mode not in ("share", "copy"):
+            raise Exception("Unknown identity mode {}.".format(mode))
+        self.mode = mode
+
+    def __enter__(self):
+        self.previous = getattr(identities, "memo", None)
+        identities.memo = ({}, self.mode == "copy")
+
+    def __exit__(self, *args):
+        identities.memo = self.previous
+
+
+class LazyGroup():
+    """Sibling instances read lazily with the same schema. A relation is
+    loaded for all of them with one query the first time any of their trees
+    accesses it."""
+
+    def __init__(self, instances, schema, using=None):
+        self.schema = schema
+        self.using = using
+        self.relations = {
+            x.k: x
+            for x in schema if isinstance(x, (one, many, recursive))
+        }
+        self.groups = {}
+        fields = [x for x in schema if x.k not in self.relations]
+        for node in fields:
+            if isinstance(node, annotate):
+                node.load_values(instances, database(using))
+        self.trees = {}
+        for x in instances:
+            if id(x) not in self.trees:
+                self.trees[id(x)] = LazyTree(self, x,
+                                             dcomp(READ, fields, x, {})[0][1])
+
+    def tree(self, instance):
+        return self.trees[id(instance)]
+
+    def load(self, k):
+        node = self.relations[k]
+        instances = [x.instance for x in self.trees.values()]
+        if isinstance(node, recursive):
+            # Read eagerly, the whole subtree comes from one query anyway.
+            node.load(instances, {"using": self.using})
+            read = recursive.reader(node)
+            for x in instances:
+                dest = {}
+                read(x, dest)
+                self.tree(x).data[k] = dest[k]
+            self.groups[k] = LazyGroup([], [], self.using)
+            return
+
+        group = self.groups[k] = LazyGroup(
+            load_branch(instances, node, database(self.using))
+            if instances else [], node.fns, self.using)
+        for x in instances:
+            value = dgets(x, k)
+            if isinstance(node, one):
+                self.tree(x).data[k] = None if value is None else group.tree(
+                    value)
+            else:
+                self.tree(x).data[k] = [
+                    group.tree(y) for y in node.restrict(value)
+                ]
+
+    def force(self):
+        """Loads every relation of the group and its descendants, one query
+        per relation."""
+        for k in self.relations:
+            if k not in self.groups:
+                self.load(k)
+            self.groups[k].force()
+
+
+class LazyTree(Mapping):
+    """Read only output of read with lazy set. Fields are read up front, one
+    and many entries on first access."""
+
+    def __init__(self, group, instance, data):
+        self.group = group
+        self.instance = instance
+        self.data = data
+
+    def __getitem__(self, k):
+        if k not in self.data and k in self.group.relations:
+            self.group.load(k)
+
+        return self.data[k]
+
+    def __iter__(self):
+        return (x.k for x in self.group.schema)
+
+    def __len__(self):
+        return len(self.group.schema)
+
+    def __repr__(self):
+        return "<LazyTree {!r}>".format(self.instance)
+
+    def force(self):
+        """Returns the output as plain dicts and lists, loading what is left
+        in as few queries as possible."""
+        self.group.force()
+
+        return unlazy(self)
+
+
+def unlazy(data):
+    if isinstance(data, LazyTree):
+        return {k: unlazy(v) for k, v in data.items()}
+    elif isinstance(data, list):
+        return [unlazy(x) for x in data]
+    else:
+        return data
+
+
+def iread(source, schema, chunk_size=2000, executor=None, using=None,
+          identity=None):
+    """Yields the tree for each instance in the queryset source. Instances are
+    fetched with iterator() and their relations loaded in bulk chunk_size
+    instances at a time, so memory stays flat regardless of queryset size.
+    With identity set, outputs are reused within each chunk, see
+    identity_map."""
+    source = project(source, schema)
+    if using is not None:
+        source = source.using(database(using))
+    iterator = source.iterator(chunk_size=chunk_size)
+    while True:
+        chunk = load(list(islice(iterator, chunk_size)), schema, executor,
+                     using)
+        if not chunk:
+            break
+        if identity is None:
+            trees = [read(x, schema) for x in chunk]
+        else:
+            with identity_map(identity):
+                trees = [read(x, schema) for x in chunk]
+        yield from trees
+        # Released before the next chunk is fetched and loaded.
+        del chunk, trees
+
+
+async def aread(source, schema, thread_sensitive=False):
+    """Async version of read for a model instance."""
+    return (await aread_all([source], schema, thread_sensitive))[0]
+
+
+async def aread_all(source, schema, thread_sensitive=False):
+    """Async version of read_all. The relations of sibling one and many nodes
+    are loaded concurrently. Unless thread_sensitive is set each load runs in
+    a worker thread with its own database connection, which does not see
+    uncommitted changes of the calling thread."""
+
+    def run(fn):
+        if thread_sensitive:
+            # Runs on the caller's connection, which must stay open.
+            return sync_to_async(fn, thread_sensitive=True)
+
+        return sync_to_async(closing(fn), thread_sensitive=False)
+
+    if isinstance(source, QuerySet):
+        source = await run(list)(project(source, schema))
+    else:
+        source = list(source)
+    await aload(source, schema, run)
+
+    # Fields left lazy, such as the instance of a foreign key field, query
+    # the database, so the trees are not built on the event loop.
+    return await run(lambda: [read(x, schema) for x in source])()
+
+
+async def aload(source, schema, run):
+    """Async version of load that loads sibling relations concurrently."""
+
+    async def branch(node):
+        related = await run(load_branch)(source, node)
+        if related:
+            await aload(related, node.fns, run)
+
+    if source:
+        prepare_prefetch(source)
+        await asyncio.gather(*[branch(x) for x in branches(schema)])
+
+    return source
+
+
+def closing(fn):
+    """Wraps fn to release the database connections of the thread it runs in
+    when done, unless that is the thread that wrapped it, whose connection
+    may be in a transaction."""
+    owner = threading.current_thread()
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            if threading.current_thread() is not owner:
+                close_old_connections()
+
+    return wrapper
+
+
+def load(source, schema, executor=None, using=None):
+    """Loads the relations of schema for the list of model instances source
+    with a single query per relation. With an executor the independent
+    relations of each level are loaded concurrently in its workers, each with
+    its own database connection. using is a database alias, or a list of
+    aliases such as read replicas to pick from for every query."""
+    if not source:
+        return source
+
+    if executor is None:
+        dcomp(LOAD, schema, source, {"using": using})
+        return source
+
+    level = [(source, schema)]
+    while level:
+        for x, _ in level:
+            prepare_prefetch(x)
+        futures = [(executor.submit(closing(load_branch), x, node,
+                                    database(using)), getattr(
+                                        node, "fns", None))
+                   for x, fns in level for node in branches(fns)]
+        level = [(future.result(), fns) for future, fns in futures]
+        level = [(x, fns) for x, fns in level if x]
+
+    return source
+
+
+def prepare_prefetch(source):
+    """Creates the prefetch cache of the instances in source, which Django
+    creates when missing, before concurrent branches could both create it
+    and lose the prefetched instances of one of them."""
+    for x in source:
+        if not hasattr(x, "_prefetched_objects_cache"):
+            x._prefetched_objects_cache = {}
+
+
+def branches(schema):
+    """Returns the nodes of schema that load with their own query."""
+    return [
+        x for x in schema if isinstance(x, (one, many, recursive, annotate))
+    ]
+
+
+def load_branch(source, node, using=None):
+    """Loads the relation of the one, many or recursive node, or the values
+    of the annotate node, for all instances in source from the database using
+    and returns the related instances whose sub schema is left to load."""
+    if isinstance(node, annotate):
+        node.load_values(source, using)
+        return []
+    elif isinstance(node, recursive):
+        return node.load_tree(source, using)
+
+    queryset = node.queryset(type(source[0]), False)
+    if using is not None:
+        queryset = queryset.using(using)
+    if isinstance(node, many) and node.windowed:
+        return load_window(source, node, queryset)
+
+    return load_related(source, node.k, queryset)
+
+
+def database(using):
+    """Returns a database alias from the alias or list of aliases using."""
+    if using is None or isinstance(using, str):
+        return using
+
+    return random.choice(using)
+
+
+def load_related(source, k, queryset):
+    """Prefetches k on all instances in source and returns the related
+    instances without duplicates. Rows fetched more than once, such as the
+    actors shared by many movies, are replaced by a single instance."""
+    prefetch_related_objects(source, Prefetch(k, queryset=queryset))
+    related = {}
+    for x in source:
+        val = dgets(x, k)
+        if isinstance(val, QuerySet):
+            val._result_cache[:] = [
+                related.setdefault((type(y), y.pk), y)
+                for y in val._result_cache
+            ]
+        elif val is not None:
+            related.setdefault(id(val), val)
+
+    return list(related.values())
+
+
+WINDOW_ROW = "treeform_row"
+WINDOW_PARENT = "treeform_parent"
+
+
+def window_sql(source, node, queryset, ids):
+    """Returns the SQL and params selecting the related instances of the many
+    node with a limit or offset for the instances of the model source with
+    ids. The rows are numbered per parent with ROW_NUMBER() and filtered in
+    an outer query, as Django can not filter on window expressions."""
+    lookup = related_lookup(source, node.k)[:-len("__in")]
+    ordering = node.order_by or queryset.model._meta.ordering or ["pk"]
+    queryset = queryset.filter(**{
+        lookup + "__in": ids
+    }).order_by().annotate(
+        **{
+            WINDOW_PARENT:
+            F(lookup),
+            WINDOW_ROW:
+            Window(RowNumber(),
+                   partition_by=[F(lookup)],
+                   order_by=[window_order(x) for x in ordering]),
+        })
+    sql, params = queryset.query.sql_with_params()
+    qn = connections[queryset.db].ops.quote_name
+    stop = "" if node.limit is None else " AND {} <= %s".format(
+        qn(WINDOW_ROW))
+
+    return ("SELECT * FROM ({}) {} WHERE {} > %s{} ORDER BY {}, {}".format(
+        sql, qn("treeform_window"), qn(WINDOW_ROW), stop, qn(WINDOW_PARENT),
+        qn(WINDOW_ROW)), params + (node.offset, ) +
+            (() if node.limit is None else (node.offset + node.limit, )))
+
+
+def window_order(x):
+    """Returns the ordering x of an order_by list as an expression."""
+    if hasattr(x, "resolve_expression"):
+        return x if isinstance(x, OrderBy) else x.asc()
+    elif x == "?":
+        raise Exception("Can not order limited many nodes randomly.")
+
+    return F(x[1:]).desc() if x.startswith("-") else F(x).asc()
+
+
+def load_window(source, node, queryset):
+    """Loads the limited many node for all instances in source with a single
+    query and stores the related instances as if they were prefetched."""
+    sql, params = window_sql(type(source[0]), node, queryset,
+                             [x.pk for x in source])
+    groups, related = {}, {}
+    for x in queryset.model._default_manager.db_manager(
+            queryset.db).raw(sql, params):
+        groups.setdefault(getattr(x, WINDOW_PARENT),
+                          []).append(related.setdefault(x.pk, x))
+
+    cache_name = prefetch_cache_name(type(source[0]), node.k)
+    for x in source:
+        store_prefetched(x, node.k, cache_name, groups.get(x.pk, []))
+
+    return list(related.values())
+
+
+def store_prefetched(instance, k, cache_name, related):
+    """Stores the list related as the prefetched instances of the many
+    relation k on instance and returns it."""
+    if not hasattr(instance, "_prefetched_objects_cache"):
+        instance._prefetched_objects_cache = {}
+    instance._prefetched_objects_cache.pop(cache_name, None)
+    cached = getattr(instance, k).all()
+    cached._result_cache = related
+    cached._prefetch_done = True
+    instance._prefetched_objects_cache[cache_name] = cached
+
+    return related
+
+
+def prefetch_cache_name(source, k):
+    """Returns the key of the many relation k in _prefetched_objects_cache."""
+    field = dgets(source, k)
+    if type(field) is ReverseManyToOneDescriptor:
+        return field.field.remote_field.get_cache_name()
+    elif type(field) is ManyToManyDescriptor:
+        return field.field.related_query_name(
+        ) if field.reverse else field.field.name
+    else:
+        raise Exception("Unknown many field type.")
+
+
+def explain(source, schema):
+    """Returns the queries read_all runs to read schema from instances of the
+    model source, in order and without touching the database. Each query is a
+    dict with the path and relation of its node, the model, the queryset,
+    its SQL with placeholders for the ids of the previous level and the
+    selected columns, None meaning all."""
+    queries = [
+        describe("", "root", project(source._default_manager.all(), schema))
+    ]
+    explain_level(source, schema, "", queries)
+
+    return queries
+
+
+def explain_level(source, schema, path, queries):
+    for node in schema:
+        if isinstance(node, (one, many)):
+            queryset = node.queryset(source, False)
+            if isinstance(node, many) and node.windowed:
+                sql, _ = window_sql(source, node, queryset, [0])
+            else:
+                queryset = queryset.filter(
+                    **{related_lookup(source, node.k): [0]})
+                sql, _ = queryset.query.sql_with_params()
+            queries.append(
+                describe(path + node.k,
+                         type(node).__name__, queryset, sql))
+            explain_level(related_model(source, node.k), node.fns,
+                          path + node.k + "__", queries)
+        elif isinstance(node, recursive):
+            queries.append(
+                describe(path + node.k, "recursive",
+                         node.tree_queryset(source, [0])))
+            explain_level(source, node.fns, path + node.k + "__", queries)
+
+
+def describe(path, relation, queryset, sql=None):
+    if sql is None:
+        sql, _ = queryset.query.sql_with_params()
+    names, defer = queryset.query.deferred_loading
+
+    return {
+        "path": path,
+        "relation": relation,
+        "model": queryset.model,
+        "queryset": queryset,
+        "sql": sql,
+        "columns": None if defer else sorted(names),
+    }
+
+
+def related_lookup(source, k):
+    """Returns the lookup that filters the related model of k by the
+    instances of source, as used when prefetching k."""
+    field = dgets(source, k)
+    if isinstance(field, ForwardManyToOneDescriptor):
+        return field.field.target_field.name + "__in"
+    elif type(field) is ReverseOneToOneDescriptor:
+        return field.related.field.name + "__in"
+    elif type(field) is ReverseManyToOneDescriptor:
+        return field.field.name + "__in"
+    elif type(field) is ManyToManyDescriptor:
+        if field.reverse:
+            return field.field.name + "__in"
+        else:
+            return field.field.related_query_name() + "__in"
+    else:
+        raise Exception("Unknown relation type for {}.".format(k))
+
+
+def count_queries(schema, roots=True):
+    """Returns the most queries read_all runs for schema. Roots that are not
+    read from a queryset need one more query per annotate node, nested
+    annotations are part of the query of their level."""
+    return 1 + (sum(isinstance(x, annotate) for x in schema) if roots else
+                0) + sum(
+                    count_queries(x.fns, False) for x in schema
+                    if isinstance(x, (one, many, recursive)))
+
+
+def assert_max_queries(source, schema, n=None, **kwargs):
+    """Runs read_all(source, schema, **kwargs) and fails if it ran more
+    than n queries, by default the count_queries bound of schema. Queries
+    are counted on every database of the calling thread, so loads run by
+    an executor in other threads are not included. Returns the output."""
+    if n is None:
+        n = count_queries(schema)
+    with ExitStack() as stack:
+        captured = [
+            stack.enter_context(CaptureQueriesContext(x))
+            for x in connections.all()
+        ]
+        output = read_all(source, schema, **kwargs)
+    count = sum(len(x) for x in captured)
+    assert count <= n, "Read ran {} queries, expected at most {}.".format(
+        count, n)
+    return output
+
+
+def write(source, schema, data):
+    """Persists data, a tree in the shape read(source, schema) returns, to
+    the model instance source. The current state is loaded and saved in bulk
+    inside a transaction. Items of many nodes are matched by primary key, so
+    the schema must read the primary key for existing rows to be updated
+    rather than replaced. The current state is read from the database rows
+    are written to, as replicas may lag behind."""
+    using = router.db_for_write(type(source))
+    with transaction.atomic(using=using):
+        if source.pk is not None:
+            load([source], schema, using=using)
+        save([(source, data)], schema)
+
+    return source
+
+
+def save(source, schema, dirty=None):
+    """Writes the list of (instance, data) pairs source to the instances and
+    saves them with one bulk query per operation. dirty maps id(instance) to
+    (instance, changed field names) for changes already made."""
+    if not source:
+        return
+
+    dest = {"saved": False, "dirty": {} if dirty is None else dirty}
+    dcomp(WRITE, schema, source, dest)
+
+    model = type(source[0][0])
+    instances = list({id(x): x for x, _ in source}.values())
+    new = [x for x in instances if x.pk is None]
+    if new:
+        connection = connections[router.db_for_write(model)]
+        if connection.features.can_return_rows_from_bulk_insert:
+            model._default_manager.bulk_create(new)
+        else:
+            for x in new:
+                x.save()
+
+    new_ids = set(id(x) for x in new)
+    changed = [
+        (x, fields) for key, (x, fields) in dest["dirty"].items()
+        if key not in new_ids
+    ]
+    if changed:
+        # Routed explicitly, bulk_update uses the read database on Django 3.0.
+        model._default_manager.db_manager(
+            router.db_for_write(model)).bulk_update(
+            [x for x, _ in changed],
+            list(set(y for _, fields in changed for y in fields)))
+
+    dcomp(WRITE, schema, source, dict(dest, saved=True, new=new_ids))
+
+
+def mark_dirty(dirty, instance, k):
+    """Records that k was changed on instance."""
+    dirty.setdefault(id(instance), (instance, set()))[1].add(k)
+
+
+def forward_related(instance, k):
+    """Returns the instance the forward relation k points to or None,
+    without raising for unset non-null relations."""
+    if getattr(instance, instance._meta.get_field(k).attname) is None:
+        return None
+
+    return dgets(instance, k)
+
+
+def fetch(model, pks):
+    """Returns a dict of pk to instance for the existing rows of pks, read
+    from the database they are written to."""
+    if not pks:
+        return {}
+    instances = model._default_manager.db_manager(
+        router.db_for_write(model)).in_bulk(list(pks))
+    missing = set(pks) - set(instances)
+    if missing:
+        raise model.DoesNotExist("{} {} does not exist.".format(
+            model._meta.object_name, ", ".join(str(x) for x in missing)))
+
+    return instances
+
+
+def plan(source, schema):
+    """Returns the select_related and prefetch_related lookups, the only
+    columns and the annotations needed to read schema from instances of the
+    model source. only is None when schema reads attributes that are not
+    columns."""
+    return dcomp(PLAN, schema, source, {
+        "select_related": [],
+        "prefetch_related": [],
+        "only": [],
+        "annotate": {},
+    })[0][1]
+
+
+def apply_plan(queryset, lookups):
+    """Applies the lookups returned by plan to queryset."""
+    if lookups["select_related"]:
+        queryset = queryset.select_related(*lookups["select_related"])
+    if lookups["prefetch_related"]:
+        queryset = queryset.prefetch_related(*lookups["prefetch_related"])
+    if lookups["only"] is not None:
+        queryset = queryset.only(*lookups["only"])
+    if lookups["annotate"]:
+        queryset = queryset.annotate(**lookups["annotate"])
+
+    return queryset
+
+
+def prefetch(queryset, schema):
+    """Applies the plan for schema to queryset."""
+    return apply_plan(queryset, plan(queryset.model, schema))
+
+
+def project(queryset, schema):
+    """Restricts queryset to the columns of its own model read by schema and
+    adds its annotations."""
+    lookups = plan(queryset.model, schema)
+    if lookups["annotate"]:
+        queryset = queryset.annotate(**lookups["annotate"])
+    if lookups["only"] is None:
+        return queryset
+
+    return queryset.only(*[x for x in lookups["only"] if "__" not in x])
+
+
+def remote_field_name(source, k):
+    """Returns the name of the field pointing back to source on the model at
+    the other end of the relation k, or None if the relation is stored on
+    source or in a join table."""
+    field = dgets(source, k)
+    if type(field) is ReverseManyToOneDescriptor:
+        return field.field.name
+    elif type(field) is ReverseOneToOneDescriptor:
+        return field.related.field.name
+    else:
+        return None
+
+
+def related_queryset(source, k, schema, lookups=True):
+    """Returns a queryset for the relation k on the model source selecting
+    only the columns read by schema. Without lookups the relations of schema
+    are left for the caller to load."""
+    model = related_model(source, k)
+    related = plan(model, schema)
+    if not lookups:
+        related["select_related"] = []
+        related["prefetch_related"] = []
+        if related["only"] is not None:
+            related["only"] = [x for x in related["only"] if "__" not in x]
+    remote = remote_field_name(source, k)
+    if related["only"] is not None and remote is not None:
+        related["only"].append(remote)
+
+    return apply_plan(model._default_manager.all(), related)
+
+
+META_CACHE_SIZE = 1024
+metas = {}
 
 
 def meta(source, schema):
-    def hash_schema(source, metadata):
-        """Returns a hash value unique to the given source and schema."""
-        return hashlib.md5(
-            serialize(source).encode("utf-8") +
-            serialize(metadata).encode("utf-8")).hexdigest()
+    """Returns the metadata of schema for the model source. Results are
+    cached by model and schema identity and must be treated as read only."""
+    key = (source, id(schema))
+    cached = metas.get(key)
+    if cached is not None and cached[0] is schema:
+        return cached[1]
 
     metadata = dcomp(META, schema, source, {})[0][1]
     metadata["version_hash"] = hash_schema(source, metadata)
+    if len(metas) >= META_CACHE_SIZE:
+        metas.clear()
+    metas[key] = (schema, metadata)
 
     return metadata
 
 
+def hash_schema(source, metadata):
+    """Returns a hash value unique to the given source and schema. Sub schemas
+    contribute their version_hash instead of their full metadata."""
+    node = {
+        k: v if k in RESERVED_KEYS else v["version_hash"]
+        for k, v in metadata.items()
+    }
+
+    return hashlib.md5(
+        serialize(source).encode("utf-8") +
+        serialize(node).encode("utf-8")).hexdigest()
+
+
+def clear_caches(**kwargs):
+    """Empties the meta cache when models or settings change."""
+    metas.clear()
+
+
+class_prepared.connect(clear_caches)
+setting_changed.connect(clear_caches)
+
+
 NULL = "__NULL__"
 META_ATTRS = (("blank", NULL), ("hidden", NULL), ("help_text", NULL),
               ("max_length", None), ("null", NULL), ("verbose_name", None),
               ("default", NOT_PROVIDED))
-RESERVED_KEYS = set(("model", "ordering", "fields", "version_hash"))
+RESERVED_KEYS = set(
+    ("model", "ordering", "fields", "options", "version_hash"))
 
 
 class field():
@@ -144,6 +1033,15 @@ class field():
         dsets(dest, self.k, dgets(source, self.k))
         return (source, dest), {}
 
+    def reader(self):
+        k = self.k
+        get = getter(k)
+
+        def field_reader(source, dest):
+            dest[k] = get(source)
+
+        return field_reader
+
     def meta(self, source, dest):
         if "model" not in dest:
             dest["model"] = source
@@ -164,6 +1062,169 @@ class field():
 
         return (source, dest), {}
 
+    def plan(self, source, dest):
+        if dest["only"] is not None:
+            try:
+                model_field = source._meta.get_field(self.k)
+            except FieldDoesNotExist:
+                model_field = None
+            if model_field is not None and model_field.concrete and not (
+                    model_field.many_to_many):
+                dest["only"].append(self.k)
+            else:
+                dest["only"] = None
+
+        return (source, dest), {}
+
+    def load(self, source, dest):
+        return (source, dest), {}
+
+    def write(self, source, dest):
+        if dest["saved"]:
+            return (source, dest), {}
+
+        for instance, data in source:
+            if self.k not in data or self.k == instance._meta.pk.name:
+                continue
+            if instance.pk is None or dgets(instance, self.k) != data[self.k]:
+                dsets(instance, self.k, data[self.k])
+                mark_dirty(dest["dirty"], instance, self.k)
+
+        return (source, dest), {}
+
+
+ANNOTATION_PREFIX = "treeform_"
+
+
+class annotate(field):
+    """Value of a query expression computed by the database, e.g.
+    annotate("title_length", Length("title")). Bulk reads annotate the
+    queries they run anyway, other reads run one query per instance."""
+
+    def __init__(self, k, expression):
+        assert k not in RESERVED_KEYS, "{} is reserved.".format(k)
+        self.k = k
+        self.expression = expression
+        self.relation = None
+
+    def resolve(self, source):
+        """Returns the expression for the model source."""
+        return self.expression
+
+    def describe(self):
+        """Returns a stable description of the expression for meta."""
+        return repr(self.expression)
+
+    def value(self, source):
+        if isinstance(source, Mapping):
+            return source[self.k]
+        try:
+            return getattr(source, ANNOTATION_PREFIX + self.k)
+        except AttributeError:
+            return type(source)._default_manager.filter(pk=source.pk).annotate(
+                value=self.resolve(type(source))).values_list(
+                    "value", flat=True).get()
+
+    def read(self, source, dest):
+        dsets(dest, self.k, self.value(source))
+        return (source, dest), {}
+
+    def reader(self):
+        k = self.k
+        value = self.value
+
+        def annotate_reader(source, dest):
+            dest[k] = value(source)
+
+        return annotate_reader
+
+    def meta(self, source, dest):
+        if "model" not in dest:
+            dest["model"] = source
+            dest["ordering"] = []
+            dest["fields"] = {}
+
+        output_field = source._default_manager.annotate(
+            value=self.resolve(source)).query.annotations["value"].output_field
+        dest["ordering"].append(self.k)
+        dest["fields"][self.k] = {
+            "type": type(output_field),
+            "null": output_field.null,
+            "expression": self.describe()
+        }
+
+        return (source, dest), {}
+
+    def plan(self, source, dest):
+        dest["annotate"][ANNOTATION_PREFIX + self.k] = self.resolve(source)
+        return (source, dest), {}
+
+    def load(self, source, dest):
+        self.load_values(source, database(dest.get("using")))
+        return (source, dest), {}
+
+    def load_values(self, source, using=None):
+        """Annotates the instances in source that were not read from an
+        annotated queryset with a single query."""
+        name = ANNOTATION_PREFIX + self.k
+        missing = [x for x in source if not hasattr(x, name)]
+        if missing:
+            model = type(missing[0])
+            values = dict(
+                model._default_manager.using(using).filter(
+                    pk__in=[x.pk for x in missing]).annotate(
+                        value=self.resolve(model)).values_list(
+                            "pk", "value"))
+            for x in missing:
+                setattr(x, name, values[x.pk])
+
+    def write(self, source, dest):
+        return (source, dest), {}
+
+
+class aggregate(annotate):
+    """Aggregate over the instances of the many relation k, e.g.
+    aggregate("movie_set", Max("age")), computed in a subquery. The output
+    key defaults to k + "__" + the default alias of the aggregate."""
+
+    def __init__(self, k, expression, name=None):
+        super().__init__(name or k + "__" + expression.default_alias,
+                         expression)
+        self.relation = k
+
+    def resolve(self, source):
+        return related_aggregate(source, self.relation, self.expression)
+
+    def describe(self):
+        return "{}: {!r}".format(self.relation, self.expression)
+
+
+class count(aggregate):
+    """Number of instances of the many relation k. The output key defaults to
+    k + "_count"."""
+
+    def __init__(self, k, name=None):
+        super().__init__(k, Count("pk"), name or k + "_count")
+
+    def resolve(self, source):
+        return Coalesce(super().resolve(source), 0)
+
+
+def related_aggregate(source, k, expression):
+    """Returns a subquery computing expression over the instances of the many
+    relation k for each row of the model source."""
+    if type(dgets(source, k)) not in (ReverseManyToOneDescriptor,
+                                      ManyToManyDescriptor):
+        raise Exception("Can only aggregate many relations.")
+
+    lookup = related_lookup(source, k)[:-len("__in")]
+
+    return Subquery(
+        related_model(source, k)._default_manager.filter(**{
+            lookup: OuterRef("pk")
+        }).order_by().values(lookup).annotate(
+            value=expression).values("value"))
+
 
 class one():
     """Django one-2-one relation."""
@@ -174,43 +1235,578 @@ class one():
         self.fns = fns
 
     def read(self, source, dest):
-        dsets(dest, self.k, read(dgets(source, self.k), self.fns))
+        dsets(dest, self.k,
+              dcomp(READ, self.fns, dgets(source, self.k), {})[0][1])
 
         return (source, dest), {}
 
+    def reader(self):
+        k = self.k
+        get = getter(k)
+        fn = compile(self.fns)
+
+        def one_reader(source, dest):
+            dest[k] = fn(get(source))
+
+        return one_reader
+
     def meta(self, source, dest):
         dsets(dest, self.k,
               meta(dgets(source, self.k).field.related_model, self.fns))
 
         return (source, dest), {}
 
+    def plan(self, source, dest):
+        lookups = plan(related_model(source, self.k), self.fns)
+        if lookups["annotate"]:
+            # Annotations can not follow select_related.
+            if dest["only"] is not None and remote_field_name(
+                    source, self.k) is None:
+                dest["only"].append(self.k)
+            dest["prefetch_related"].append(
+                Prefetch(self.k, queryset=self.queryset(source)))
+            return (source, dest), {}
+
+        if dest["only"] is not None:
+            if remote_field_name(source, self.k) is None:
+                dest["only"].append(self.k)
+            if lookups["only"] is not None:
+                dest["only"].extend(self.k + "__" + x for x in lookups["only"])
+        dest["select_related"].append(self.k)
+        dest["select_related"].extend(
+            self.k + "__" + x for x in lookups["select_related"])
+        dest["prefetch_related"].extend(
+            Prefetch(self.k + "__" + x.prefetch_through, queryset=x.queryset)
+            for x in lookups["prefetch_related"])
+
+        return (source, dest), {}
+
+    def load(self, source, dest):
+        related = load_branch(source, self, database(dest.get("using")))
+        if related:
+            dcomp(LOAD, self.fns, related, dest)
+
+        return (source, dest), {}
+
+    def queryset(self, source, lookups=True):
+        """Returns the queryset loading this relation from the model
+        source."""
+        return related_queryset(source, self.k, self.fns, lookups)
+
+    def write(self, source, dest):
+        if dest["saved"]:
+            return (source, dest), {}
+
+        model = related_model(type(source[0][0]), self.k)
+        if remote_field_name(type(source[0][0]), self.k) is not None:
+            raise Exception("Can only write forward one relations.")
+
+        pk_name = model._meta.pk.name
+        pairs, parents, pks = [], [], set()
+        for instance, data in source:
+            if self.k not in data:
+                continue
+            value = data[self.k]
+            current = forward_related(instance, self.k)
+            if value is None:
+                if current is not None:
+                    dsets(instance, self.k, None)
+                    mark_dirty(dest["dirty"], instance, self.k)
+                continue
+            if value.get(pk_name) is not None and (
+                    current is None or value[pk_name] != current.pk):
+                pks.add(value[pk_name])
+            pairs.append((instance, current, value))
+
+        fetched = fetch(model, pks)
+        related = []
+        for instance, current, value in pairs:
+            pk = value.get(pk_name)
+            if current is not None and (pk is None or pk == current.pk):
+                x = current
+            elif pk is not None:
+                x = fetched[pk]
+            else:
+                x = model()
+            related.append((x, value))
+            parents.append((instance, x))
+
+        save(related, self.fns)
+        for instance, x in parents:
+            if forward_related(instance, self.k) is not x:
+                dsets(instance, self.k, x)
+                mark_dirty(dest["dirty"], instance, self.k)
+
+        return (source, dest), {}
+
 
 class many():
-    """Django one-2-many or many-2-many mapping."""
+    """Django one-2-many or many-2-many mapping. The related instances can be
+    narrowed with filter, a Q object or dict of lookups, sorted with
+    order_by and paged with limit and offset. All options run in the
+    database, limits per parent when reading in bulk."""
 
-    def __init__(self, k, fns):
+    def __init__(self, k, fns, filter=None, order_by=None, limit=None,
+                 offset=0):
         assert k not in RESERVED_KEYS, "{} is reserved.".format(k)
         self.k = k
         self.fns = fns
+        self.filter = Q(**filter) if isinstance(filter, dict) else filter
+        self.order_by = list(order_by) if order_by is not None else None
+        self.limit = limit
+        self.offset = offset
+        assert not (self.windowed and "?" in (self.order_by or [])), (
+            "Limited many nodes can not be ordered randomly.")
+
+    @property
+    def windowed(self):
+        return self.limit is not None or self.offset
+
+    def restrict(self, related):
+        """Applies the options to the related instances of one parent."""
+        if not isinstance(related, QuerySet):
+            return related[self.offset:None if self.limit is None else self.
+                           offset + self.limit]
+        elif related._result_cache is not None:
+            if not self.windowed or (related._result_cache and hasattr(
+                    related._result_cache[0], WINDOW_ROW)):
+                return related
+            return related._result_cache[self.offset:None if self.limit is
+                                         None else self.offset + self.limit]
+
+        if self.filter is not None:
+            related = related.filter(self.filter)
+        if self.order_by is not None:
+            related = related.order_by(*self.order_by)
+        if self.windowed:
+            related = related[self.offset:None if self.limit is None else self
+                              .offset + self.limit]
+
+        return related
+
+    def options(self):
+        options = {}
+        if self.filter is not None:
+            options["filter"] = str(self.filter)
+        if self.order_by is not None:
+            options["order_by"] = [str(x) for x in self.order_by]
+        if self.limit is not None:
+            options["limit"] = self.limit
+        if self.offset:
+            options["offset"] = self.offset
+
+        return options
 
     def read(self, source, dest):
         dsets(dest, self.k, [
-            dcomp(READ, self.fns, x, {})[0][1] for x in dgets(source, self.k)
+            dcomp(READ, self.fns, x, {})[0][1]
+            for x in self.restrict(dgets(source, self.k))
         ])
 
         return (source, dest), {}
 
+    def reader(self):
+        k = self.k
+        get = getter(k)
+        fn = compile(self.fns)
+        restrict = self.restrict
+
+        def many_reader(source, dest):
+            dest[k] = [fn(x) for x in restrict(get(source))]
+
+        return many_reader
+
     def meta(self, source, dest):
-        field = dgets(source, self.k)
-        if type(field) is ReverseManyToOneDescriptor:
-            dsets(dest, self.k, meta(field.rel.related_model, self.fns))
-        elif type(field) is ManyToManyDescriptor:
-            dsets(dest, self.k, meta(field.rel.model, self.fns))
-        else:
+        if type(dgets(source, self.k)) not in (ReverseManyToOneDescriptor,
+                                               ManyToManyDescriptor):
             raise Exception("Unknown many field type.")
 
+        model = related_model(source, self.k)
+        metadata = meta(model, self.fns)
+        options = self.options()
+        if options:
+            metadata = dict(metadata, options=options)
+            del metadata["version_hash"]
+            metadata["version_hash"] = hash_schema(model, metadata)
+        dsets(dest, self.k, metadata)
+
+        return (source, dest), {}
+
+    def plan(self, source, dest):
+        dest["prefetch_related"].append(
+            Prefetch(self.k, queryset=self.queryset(source)))
+
+        return (source, dest), {}
+
+    def queryset(self, source, lookups=True):
+        """Returns the queryset loading this relation from the model source
+        with filter and order_by applied. Limits are applied per parent by
+        load_window or restrict."""
+        queryset = related_queryset(source, self.k, self.fns, lookups)
+        if self.filter is not None:
+            queryset = queryset.filter(self.filter)
+        if self.order_by is not None:
+            queryset = queryset.order_by(*self.order_by)
+
+        return queryset
+
+    def load(self, source, dest):
+        related = load_branch(source, self, database(dest.get("using")))
+        if related:
+            dcomp(LOAD, self.fns, related, dest)
+
+        return (source, dest), {}
+
+    def write(self, source, dest):
+        if not dest["saved"]:
+            return (source, dest), {}
+
+        if self.options():
+            raise Exception("Can not write many relations with options.")
+
+        parent = type(source[0][0])
+        model = related_model(parent, self.k)
+        descriptor = dgets(parent, self.k)
+        remote = remote_field_name(parent, self.k)
+        pk_name = model._meta.pk.name
+
+        items, pks = [], set()
+        for instance, data in source:
+            if self.k not in data:
+                continue
+            current = {} if id(instance) in dest["new"] else {
+                x.pk: x
+                for x in dgets(instance, self.k)
+            }
+            for value in data[self.k]:
+                if value.get(pk_name) is not None and (value[pk_name]
+                                                       not in current):
+                    pks.add(value[pk_name])
+            items.append((instance, current, data[self.k]))
+
+        fetched = fetch(model, pks)
+        related, dirty, removed, added = [], {}, [], []
+        for instance, current, values in items:
+            seen = set()
+            for value in values:
+                pk = value.get(pk_name)
+                if pk in current:
+                    x = current[pk]
+                elif pk is not None:
+                    x = fetched[pk]
+                    added.append((instance, x))
+                else:
+                    x = model()
+                    added.append((instance, x))
+                if remote is not None and (x.pk is None or getattr(
+                        x,
+                        model._meta.get_field(remote).attname) != instance.pk):
+                    dsets(x, remote, instance)
+                    mark_dirty(dirty, x, remote)
+                seen.add(pk)
+                related.append((x, value))
+            removed.extend(
+                (instance, x) for pk, x in current.items() if pk not in seen)
+            if hasattr(instance, "_prefetched_objects_cache"):
+                instance._prefetched_objects_cache.clear()
+
+        save(related, self.fns, dirty)
+
+        if type(descriptor) is ReverseManyToOneDescriptor:
+            # Rows moved to another parent of this level are kept.
+            kept = set(x.pk for x, _ in related)
+            removed = [x.pk for _, x in removed if x.pk not in kept]
+            if removed and model._meta.get_field(remote).null:
+                model._default_manager.filter(pk__in=removed).update(
+                    **{remote: None})
+            elif removed:
+                model._default_manager.filter(pk__in=removed).delete()
+        else:
+            through = descriptor.through
+            if descriptor.reverse:
+                source_name = descriptor.field.m2m_reverse_field_name()
+                target_name = descriptor.field.m2m_field_name()
+            else:
+                source_name = descriptor.field.m2m_field_name()
+                target_name = descriptor.field.m2m_reverse_field_name()
+            if removed:
+                condition = Q()
+                for instance, x in removed:
+                    condition |= Q(**{
+                        source_name: instance.pk,
+                        target_name: x.pk
+                    })
+                through._default_manager.filter(condition).delete()
+            if added:
+                through._default_manager.bulk_create([
+                    through(**{
+                        source_name: instance,
+                        target_name: x
+                    }) for instance, x in added
+                ])
+
+        return (source, dest), {}
+
+
+class recursive():
+    """Django one-2-many relation of a model to itself, such as the children of
+    a category, read down to max_depth levels or to the leaves. The whole
+    subtree is loaded with a single recursive query. Entries at max_depth
+    have an empty list for k."""
+
+    def __init__(self, k, fns, max_depth=None):
+        assert k not in RESERVED_KEYS, "{} is reserved.".format(k)
+        self.k = k
+        self.fns = fns
+        self.max_depth = max_depth
+
+    def read(self, source, dest):
+        # Not self.reader, which profiled turns off, nor compile, whose cache
+        # would fill with the copies profiled makes.
+        recursive.reader(self, lambda x: dcomp(READ, self.fns, x, {})[0][1])(
+            source, dest)
+        return (source, dest), {}
+
+    def reader(self, fn=None):
+        k = self.k
+        get = getter(k)
+        fn = fn or compile(self.fns)
+        max_depth = self.max_depth
+        load = self.load
+
+        def build(source, depth):
+            # Copied as fn may return an output shared by the identity map.
+            dest = dict(fn(source))
+            if max_depth is not None and depth >= max_depth:
+                dest[k] = []
+            else:
+                dest[k] = [build(x, depth + 1) for x in get(source)]
+
+            return dest
+
+        def recursive_reader(source, dest):
+            if isinstance(source, Model) and prefetch_cache_name(
+                    type(source), k) not in getattr(
+                        source, "_prefetched_objects_cache", {}):
+                load([source], {})
+            dest[k] = build(source, 0)[k]
+
+        return recursive_reader
+
+    def meta(self, source, dest):
+        self.check(source)
+        metadata = dict(meta(source, self.fns),
+                        options={
+                            "recursive": True,
+                            "max_depth": self.max_depth
+                        })
+        del metadata["version_hash"]
+        metadata["version_hash"] = hash_schema(source, metadata)
+        dsets(dest, self.k, metadata)
+
+        return (source, dest), {}
+
+    def plan(self, source, dest):
+        return (source, dest), {}
+
+    def load(self, source, dest):
+        rows = self.load_tree(source, database(dest.get("using")))
+        if rows:
+            dcomp(LOAD, self.fns, rows, dest)
+
         return (source, dest), {}
 
+    def check(self, source):
+        if type(dgets(source, self.k)) is not ReverseManyToOneDescriptor or (
+                related_model(source, self.k) is not source):
+            raise Exception("Can only recurse relations of a model to "
+                            "itself.")
+
+    def queryset(self, source, lookups=True):
+        """Returns the queryset loading this relation from the model
+        source."""
+        self.check(source)
+        queryset = related_queryset(source, self.k, self.fns, lookups)
+
+        return queryset.order_by(*(source._meta.ordering or ["pk"]))
+
+    def tree_queryset(self, source, ids):
+        """Returns the queryset of all descendants of the instances of the
+        model source with ids down to max_depth, selected with a recursive
+        common table expression."""
+        queryset = self.queryset(source, False)
+        qn = connections[queryset.db].ops.quote_name
+        table = qn(source._meta.db_table)
+        pk = qn(source._meta.pk.column)
+        fk = qn(
+            source._meta.get_field(remote_field_name(source, self.k)).column)
+        sql = ("WITH RECURSIVE treeform_tree (id, depth) AS ("
+               "SELECT {pk}, 1 FROM {table} WHERE {fk} IN ({ids}) "
+               "UNION ALL SELECT {table}.{pk}, treeform_tree.depth + 1 "
+               "FROM {table} INNER JOIN treeform_tree "
+               "ON {table}.{fk} = treeform_tree.id{depth}) "
+               "SELECT id FROM treeform_tree").format(
+                   table=table, pk=pk, fk=fk,
+                   ids=", ".join(["%s"] * len(ids)),
+                   depth="" if self.max_depth is None else
+                   " WHERE treeform_tree.depth < %s")
+        params = list(ids) + ([] if self.max_depth is None else
+                              [self.max_depth])
+
+        return queryset.filter(pk__in=RawSQL(sql, params))
+
+    def load_tree(self, source, using=None):
+        """Loads the descendants of the instances in source with one query,
+        stores them as the prefetched children of their parents and returns
+        them."""
+        if not source:
+            return []
+
+        model = type(source[0])
+        queryset = self.tree_queryset(model, [x.pk for x in source])
+        if using is not None:
+            queryset = queryset.using(using)
+        rows = list(queryset)
+
+        attname = model._meta.get_field(remote_field_name(model,
+                                                          self.k)).attname
+        children = {}
+        for x in rows:
+            children.setdefault(getattr(x, attname), []).append(x)
+
+        cache_name = prefetch_cache_name(model, self.k)
+        level, depth = source, 0
+        while level and (self.max_depth is None or depth < self.max_depth):
+            level = [
+                y for x in level for y in store_prefetched(
+                    x, self.k, cache_name, children.get(x.pk, []))
+            ]
+            depth += 1
+
+        return rows
+
+    def write(self, source, dest):
+        raise Exception("Can not write recursive relations.")
+
+
+### Profiling ###
+
+profiling = threading.local()
+# Threads inside a measure, post_init is only connected while there are any.
+measuring = {"lock": threading.Lock(), "threads": 0}
+
+
+def stat(node, k, children=()):
+    return {
+        "node": node,
+        "k": k,
+        "queries": 0,
+        "rows": 0,
+        "objects": 0,
+        "time": 0.0,
+        "children": list(children),
+    }
+
+
+def profiled(schema):
+    """Returns a copy of schema that records statistics when read or loaded
+    and the stats tree mirroring schema it records them in. Every node gets
+    the number of queries it issued, rows it read, model instances created
+    and wall time in seconds, including those of its children. Batch reads
+    are profiled by passing the copy to read_all inside measure(stats)."""
+    nodes, children = [], []
+    for node in schema:
+        node = copy.copy(node)
+        if hasattr(node, "fns"):
+            node.fns, stats = profiled(node.fns)
+            stats["node"], stats["k"] = type(node).__name__, node.k
+        else:
+            stats = stat(type(node).__name__, getattr(node, "k", None))
+        for mode in (READ, LOAD):
+            if hasattr(node, mode):
+                setattr(node, mode, measured(getattr(node, mode), mode,
+                                             stats))
+        node.reader = None
+        nodes.append(node)
+        children.append(stats)
+
+    return nodes, stat("schema", None, children)
+
+
+def measured(fn, mode, stats):
+    """Wraps the mode method fn of a node to record into stats."""
+
+    def wrapper(source, dest):
+        with measure(stats):
+            result = fn(source, dest)
+        if mode == READ:
+            value = dgets(dest, stats["k"])
+            stats["rows"] += (len(value) if isinstance(value, list) else
+                              int(value is not None))
+
+        return result
+
+    return wrapper
+
+
+class measure():
+    """Context manager adding the queries, created model instances and time
+    spent inside it to stats and any enclosing measure."""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def __enter__(self):
+        if not hasattr(profiling, "stack"):
+            profiling.stack = []
+        if not profiling.stack:
+            self.hooks = ExitStack()
+            for connection in connections.all():
+                self.hooks.enter_context(
+                    connection.execute_wrapper(count_query))
+            with measuring["lock"]:
+                if not measuring["threads"]:
+                    post_init.connect(count_object, dispatch_uid=__name__)
+                measuring["threads"] += 1
+        profiling.stack.append(self.stats)
+        self.start = time.perf_counter()
+
+        return self.stats
+
+    def __exit__(self, *args):
+        self.stats["time"] += time.perf_counter() - self.start
+        profiling.stack.pop()
+        if not profiling.stack:
+            self.hooks.close()
+            with measuring["lock"]:
+                measuring["threads"] -= 1
+                if not measuring["threads"]:
+                    post_init.disconnect(count_object,
+                                         dispatch_uid=__name__)
+
+
+def count_query(execute, sql, params, many, context):
+    for stats in getattr(profiling, "stack", ()):
+        stats["queries"] += 1
+
+    return execute(sql, params, many, context)
+
+
+def count_object(**kwargs):
+    for stats in getattr(profiling, "stack", ()):
+        stats["objects"] += 1
+
+
+def pp_stats(stats, depth=0):
+    """Pretty prints a stats tree from profiled."""
+    name = stats["node"] if stats["k"] is None else "{} ({})".format(
+        stats["k"], stats["node"])
+    print("{}{}: {} queries, {} rows, {} objects, {:.2f} ms".format(
+        "    " * depth, name, stats["queries"], stats["rows"],
+        stats["objects"], stats["time"] * 1000))
+    for child in stats["children"]:
+        pp_stats(child, depth + 1)
+
 
 ### Other ###
 
@@ -221,10 +1817,14 @@ CDT_NOT_PROVIDED = "treeform.not_provided"
 
 
 def pp(data):
-    print(serialize(data, indent=4))
+    for chunk in iserialize(data, indent=4):
+        sys.stdout.write(chunk.decode("utf-8"))
+    sys.stdout.write("\n")
 
 
 def default(thing):
+    if isinstance(thing, LazyTree):
+        return thing.force()
     if issubclass(thing, Model):
         return [CUSTOM_DATA_TYPE, CDT_DJANGO_MODEL, str(thing._meta)]
     if issubclass(thing, Field):
@@ -242,6 +1842,57 @@ def serialize(data, indent=None):
     return json.dumps(data, default=default, indent=indent)
 
 
+CHUNK_SIZE = 65536
+
+
+def chunked(parts, chunk_size=CHUNK_SIZE):
+    """Joins the strings in parts into utf-8 chunks of about chunk_size."""
+    buffer, size = [], 0
+    for part in parts:
+        buffer.append(part)
+        size += len(part)
+        if size >= chunk_size:
+            yield "".join(buffer).encode("utf-8")
+            buffer, size = [], 0
+    if buffer:
+        yield "".join(buffer).encode("utf-8")
+
+
+def iserialize(data, indent=None, chunk_size=CHUNK_SIZE):
+    """Yields serialize(data, indent) as chunks of bytes."""
+    return chunked(
+        json.JSONEncoder(default=default, indent=indent).iterencode(data),
+        chunk_size)
+
+
+def iserialize_all(trees, ndjson=False, chunk_size=CHUNK_SIZE):
+    """Yields the iterable trees as chunks of bytes, either as a JSON array or
+    with ndjson as one JSON document per line. The chunks can be passed
+    directly to a StreamingHttpResponse."""
+    encoder = json.JSONEncoder(default=default)
+
+    def parts():
+        if ndjson:
+            for tree in trees:
+                yield from encoder.iterencode(tree)
+                yield "\n"
+        else:
+            yield "["
+            for i, tree in enumerate(trees):
+                if i:
+                    yield ", "
+                yield from encoder.iterencode(tree)
+            yield "]"
+
+    return chunked(parts(), chunk_size)
+
+
+def dump(trees, fp, ndjson=False, chunk_size=CHUNK_SIZE):
+    """Writes the iterable trees to the binary file-like object fp."""
+    for chunk in iserialize_all(trees, ndjson, chunk_size):
+        fp.write(chunk)
+
+
 if __name__ == "__main__":
     source = {
         "title":
@@ -0,0 +1,291 @@
+import re
+
+from django.db import connections
+from django.db.backends.utils import truncate_name
+from django.db.models.fields.related_descriptors import (
+    ForwardManyToOneDescriptor, ReverseOneToOneDescriptor,
+    ReverseManyToOneDescriptor, ManyToManyDescriptor)
+
+from treeform.models import SchemaVersion
+from treeform.treeform import (field, one, many, annotate, recursive,
+                               dgets)
+
+EVENTS = ("INSERT", "UPDATE", "DELETE")
+
+
+def quote(name):
+    return '"{}"'.format(name)
+
+
+def literal(value):
+    return "'{}'".format(value.replace("'", "''"))
+
+
+def pk(model):
+    return quote(model._meta.pk.column)
+
+
+def table(model):
+    return quote(model._meta.db_table)
+
+
+def m2m_columns(descriptor):
+    """Returns the through model and the columns pointing to the parent and
+    child side of a many-2-many descriptor."""
+    model_field = descriptor.field
+    through = model_field.remote_field.through
+    if descriptor.reverse:
+        return (through, model_field.m2m_reverse_name(),
+                model_field.m2m_column_name())
+    else:
+        return (through, model_field.m2m_column_name(),
+                model_field.m2m_reverse_name())
+
+
+def step(edge, ids):
+    """Returns SQL selecting the parent ids of edge for the child ids."""
+    parent, descriptor = edge
+    if isinstance(descriptor, ForwardManyToOneDescriptor):
+        return "SELECT {} AS id FROM {} WHERE {} IN ({})".format(
+            pk(parent), table(parent), quote(descriptor.field.column), ids)
+    elif type(descriptor) in (ReverseOneToOneDescriptor,
+                              ReverseManyToOneDescriptor):
+        model_field = remote_field(descriptor)
+        return "SELECT {} AS id FROM {} WHERE {} IN ({})".format(
+            quote(model_field.column), table(model_field.model),
+            pk(model_field.model), ids)
+    elif type(descriptor) is ManyToManyDescriptor:
+        through, parent_column, child_column = m2m_columns(descriptor)
+        return "SELECT {} AS id FROM {} WHERE {} IN ({})".format(
+            quote(parent_column), table(through), quote(child_column), ids)
+    elif isinstance(descriptor, recursive):
+        return ancestors(parent, descriptor, ids)
+    else:
+        raise Exception("Unknown relation type.")
+
+
+def ancestors(model, node, ids, levels=None):
+    """Returns SQL selecting the ancestors of ids within max_depth levels of
+    the recursive node. SQLite does not allow recursive CTEs in triggers, so
+    the levels are unrolled."""
+    column = quote(remote_field(dgets(model, node.k)).column)
+    levels = [] if levels is None else levels
+    while len(levels) < node.max_depth:
+        ids = "SELECT {} AS id FROM {} WHERE {} IN ({})".format(
+            column, table(model), pk(model), ids)
+        levels.append(ids)
+
+    return " UNION ".join(levels)
+
+
+def row_step(edge, row, child):
+    """Returns SQL selecting the parent ids of edge for the child row."""
+    parent, descriptor = edge
+    if type(descriptor) in (ReverseOneToOneDescriptor,
+                            ReverseManyToOneDescriptor):
+        return "SELECT {}.{} AS id".format(
+            row, quote(remote_field(descriptor).column))
+    elif isinstance(descriptor, recursive):
+        ids = "SELECT {}.{} AS id".format(
+            row, quote(remote_field(dgets(parent, descriptor.k)).column))
+        return ancestors(parent, descriptor, ids, [ids])
+    else:
+        return step(edge, "SELECT {}.{} AS id".format(row, pk(child)))
+
+
+def remote_field(descriptor):
+    if type(descriptor) is ReverseOneToOneDescriptor:
+        return descriptor.related.field
+    else:
+        return descriptor.field
+
+
+def root_ids(path, ids):
+    """Returns SQL selecting the root ids for ids at the end of path."""
+    for edge in reversed(path):
+        ids = step(edge, ids)
+
+    return ids
+
+
+def tables(model, schema, path=(), narrowed=False):
+    """Yields (model, path, columns) for every table whose rows are read by
+    schema from model. columns are the columns whose updates change the
+    output, or None if any column might. narrowed means the rows are
+    filtered or ordered by a many node, on columns that may not be read."""
+    columns = None if narrowed else set([model._meta.pk.column])
+    if path and columns is not None:
+        descriptor = path[-1][1]
+        if type(descriptor) in (ReverseOneToOneDescriptor,
+                                ReverseManyToOneDescriptor):
+            columns.add(remote_field(descriptor).column)
+        elif isinstance(descriptor, recursive):
+            columns.add(
+                remote_field(dgets(model, descriptor.k)).column)
+
+    for node in schema:
+        if isinstance(node, annotate):
+            columns = None
+            if node.relation is None:
+                continue
+            # Aggregates depend on any column of the related rows.
+            node = many(node.relation, [annotate(node.k, None)])
+
+        if isinstance(node, recursive):
+            if node.max_depth is None:
+                raise Exception("Triggers need a max_depth for recursive "
+                                "node {}.".format(node.k))
+            node.check(model)
+            yield from tables(model, node.fns, path + ((model, node), ))
+        elif isinstance(node, field):
+            model_field = model._meta.get_field(node.k)
+            if not model_field.concrete or model_field.many_to_many:
+                columns = None
+            elif columns is not None:
+                columns.add(model_field.column)
+        elif isinstance(node, (one, many)):
+            descriptor = dgets(model, node.k)
+            if isinstance(descriptor, ForwardManyToOneDescriptor):
+                if columns is not None:
+                    columns.add(descriptor.field.column)
+                child = descriptor.field.related_model
+            elif type(descriptor) is ReverseOneToOneDescriptor:
+                child = descriptor.related.related_model
+            elif type(descriptor) is ReverseManyToOneDescriptor:
+                child = descriptor.rel.related_model
+            elif type(descriptor) is ManyToManyDescriptor:
+                through, _, _ = m2m_columns(descriptor)
+                yield through, path + ((model, descriptor), ), None
+                child = (descriptor.rel.related_model
+                         if descriptor.reverse else descriptor.rel.model)
+            else:
+                raise Exception("Unknown relation type.")
+            yield from tables(
+                child, node.fns, path + ((model, descriptor), ),
+                isinstance(node, many) and bool(node.options()))
+        else:
+            columns = None
+
+    yield model, path, columns
+
+
+def affected_ids(model, path, row):
+    """Returns SQL selecting the root ids affected by a row in model."""
+    if not path:
+        return "SELECT {}.{} AS id".format(row, pk(model))
+    elif (type(path[-1][1]) is ManyToManyDescriptor
+          and model is m2m_columns(path[-1][1])[0]):
+        _, parent_column, _ = m2m_columns(path[-1][1])
+        return root_ids(path[:-1],
+                        "SELECT {}.{} AS id".format(row, quote(parent_column)))
+    else:
+        return root_ids(path[:-1], row_step(path[-1], row, model))
+
+
+def bump(name, ids):
+    """Returns SQL statements bumping the version of name for ids."""
+    versions = table(SchemaVersion)
+    schema = quote(SchemaVersion._meta.get_field("schema").column)
+    version = quote(SchemaVersion._meta.get_field("version").column)
+    object_id = quote(SchemaVersion._meta.get_field("object_id").column)
+
+    # A single upsert, as concurrent transactions creating the first row of a
+    # root with a separate UPDATE and INSERT would both insert it.
+    return [
+        "INSERT INTO {versions} ({schema}, {version}, {object_id}) "
+        "SELECT DISTINCT {name}, 1, ids.id FROM ({ids}) AS ids "
+        "WHERE ids.id IS NOT NULL ON CONFLICT ({schema}, {object_id}) "
+        "DO UPDATE SET {version} = {versions}.{version} + 1".format(
+            versions=versions, version=version, schema=schema,
+            name=literal(name), object_id=object_id, ids=ids),
+    ]
+
+
+def trigger_name(name, model, event):
+    return truncate_name(
+        re.sub(r"\W", "_", "treeform_{}_{}_{}".format(
+            name, model._meta.db_table, event)).lower(), 63)
+
+
+def triggers(model, schema, name):
+    """Returns (model, event, columns, statements) for each trigger needed to
+    keep the SchemaVersion rows of name up to date for schema read from
+    model."""
+    affected = {}
+    for table_model, path, columns in tables(model, schema):
+        paths, all_columns = affected.get(table_model, ([], set()))
+        if all_columns is not None and columns is not None:
+            all_columns = all_columns | columns
+        else:
+            all_columns = None
+        affected[table_model] = (paths + [path], all_columns)
+
+    for table_model, (paths, columns) in affected.items():
+        for event in EVENTS:
+            rows = {"INSERT": ["NEW"], "UPDATE": ["OLD", "NEW"],
+                    "DELETE": ["OLD"]}[event]
+            ids = " UNION ".join(
+                affected_ids(table_model, path, row) for path in paths
+                for row in rows)
+            yield (table_model, event, columns if event == "UPDATE" else None,
+                   bump(name, ids))
+
+
+def create_sql(model, schema, name, vendor):
+    """Returns the DDL creating the SchemaVersion triggers for vendor."""
+    sql = drop_sql(model, schema, name, vendor)
+    for table_model, event, columns, statements in triggers(
+            model, schema, name):
+        trigger = quote(trigger_name(name, table_model, event))
+        on = "AFTER {}{} ON {}".format(
+            event, " OF " + ", ".join(quote(x) for x in sorted(columns))
+            if columns else "", table(table_model))
+        body = "".join("    {};\n".format(x) for x in statements)
+        if vendor == "sqlite":
+            sql.append("CREATE TRIGGER {} {} FOR EACH ROW BEGIN\n{}END".format(
+                trigger, on, body))
+        elif vendor == "postgresql":
+            sql.append(
+                "CREATE OR REPLACE FUNCTION {}() RETURNS trigger AS $$\n"
+                "BEGIN\n{}    RETURN NULL;\nEND;\n$$ LANGUAGE plpgsql".format(
+                    trigger, body))
+            sql.append(
+                "CREATE TRIGGER {} {} FOR EACH ROW EXECUTE PROCEDURE {}()".
+                format(trigger, on, trigger))
+        else:
+            raise Exception("Unsupported database vendor {}.".format(vendor))
+
+    return sql
+
+
+def drop_sql(model, schema, name, vendor):
+    """Returns the DDL dropping the SchemaVersion triggers for vendor."""
+    sql = []
+    for table_model, event, _, _ in triggers(model, schema, name):
+        trigger = quote(trigger_name(name, table_model, event))
+        if vendor == "sqlite":
+            sql.append("DROP TRIGGER IF EXISTS {}".format(trigger))
+        elif vendor == "postgresql":
+            sql.append("DROP TRIGGER IF EXISTS {} ON {}".format(
+                trigger, table(table_model)))
+            sql.append("DROP FUNCTION IF EXISTS {}()".format(trigger))
+        else:
+            raise Exception("Unsupported database vendor {}.".format(vendor))
+
+    return sql
+
+
+def install(model, schema, name, using="default"):
+    """Creates the SchemaVersion triggers on the database using."""
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        for statement in create_sql(model, schema, name, connection.vendor):
+            cursor.execute(statement)
+
+
+def uninstall(model, schema, name, using="default"):
+    """Drops the SchemaVersion triggers from the database using."""
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        for statement in drop_sql(model, schema, name, connection.vendor):
+            cursor.execute(statement)